@@ -5,13 +5,1388 @@
 ## based on https://github.com/Einstein42/myq-garage
 
 import os
+import errno
+import fcntl
 import plistlib
+import select
 import sys
 import time
+import bisect
+import functools
+import heapq
+import itertools
+import json
 import logging
+import threading
 import xml.etree.ElementTree as ET
+from array import array
+from collections import namedtuple, deque, Counter
+
+kCurDevVersCount = 2        # current version of plugin devices
+kMaxTimerWait = 5.0         # seconds runConcurrentThread waits when no timer is due sooner
+kCatalogRefresh = 60.0      # seconds between background checks of the Plugins folders
+kDispatchWorkers = 3        # threads sending masquerade actions to the base devices
+kPluginHandleTTL = 300.0    # seconds a cached indigo.server.getPlugin() handle is reused
+kBreakerThreshold = 3       # consecutive failures that open a target plugin's circuit
+kBreakerCooldown = 30.0     # seconds an open circuit drops commands before trying again
+kActionTimeout = 10.0       # executeAction calls slower than this count as failures
+kMaxPluginCalls = 1         # executeAction calls in flight per target plugin
+kReconcileDelay = 0.5       # seconds to collect starting devices before reconciling them in one pass
+kWarningInterval = 300.0    # seconds a repeated warning is counted instead of logged
+kRollingCapacity = 1024     # samples kept per device for rolling statistics
+kRollingRefresh = 60.0      # seconds between refreshes of rolling statistics that have aged
+kStaleError = u"no update"  # error state shown by a masquerade whose base devices have gone quiet
+
+logger = logging.getLogger("Plugin")
+
+
+def propBool(value):
+    # checkbox props can arrive as real booleans or as the strings "true" / "false"
+    if isinstance(value, basestring):
+        return value.strip().lower() in (u"true", u"yes", u"1")
+    return bool(value)
+
+
+class PropError(ValueError):
+    # a device prop that can't be compiled, key is the ConfigUI field id
+
+    def __init__(self, key, message):
+        ValueError.__init__(self, message)
+        self.key = key
+
+
+def propInt(props, key, default):
+    try:
+        return int(props.get(key, default))
+    except (TypeError, ValueError):
+        raise PropError(key, u"Must be a whole number")
+
+
+def propFloat(props, key, default=0.0):
+    # optional non-negative numeric props, blank means the default
+    value = props.get(key, u"")
+    if isinstance(value, basestring) and not value.strip():
+        return default
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise PropError(key, u"Must be a number")
+    if value < 0:
+        raise PropError(key, u"Must not be negative")
+    return value
+
+
+class LimitedLog(object):
+
+    # Warnings that can repeat on every device update.  The first one for a key is
+    # logged, repeats in the next kWarningInterval seconds are only counted, and
+    # flush() logs one summary for them when the interval is over.
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.entries = {}               # key -> [interval end, repeats, last message, last args]
+
+    def warning(self, key, message, *args):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now < entry[0]:
+                entry[1] += 1
+                entry[2] = message
+                entry[3] = args
+                return
+            self.entries[key] = [now + self.interval, 0, message, args]
+        if entry is not None and entry[1]:
+            self.summary(entry)
+        logger.warning(message, *args)
+
+    def flush(self):
+        now = time.time()
+        with self.lock:
+            expired = [key for key, entry in self.entries.iteritems() if now >= entry[0]]
+            expired = [self.entries.pop(key) for key in expired]
+        for entry in expired:
+            if entry[1]:
+                self.summary(entry)
+
+    def summary(self, entry):
+        logger.warning(u"%s (repeated %d times in the last %d minutes)", entry[2] % entry[3], entry[1], self.interval / 60)
+
+
+limitedLog = LimitedLog(kWarningInterval)
+
+
+################################################################################
+#
+#   Timer queue serviced by runConcurrentThread
+#
+#   A heap of (due time, sequence, key).  Scheduling a key that is already pending
+#   replaces the earlier timer, cancelled entries are dropped lazily when they reach
+#   the top of the heap.
+#
+#   wait() blocks in select() on a pipe until the first timer is due, at most maxWait.
+#   A timer scheduled ahead of the others writes a byte to the pipe to cut the wait
+#   short.  (threading.Condition.wait with a timeout polls every 50 ms on Python 2.)
+#   So the thread wakes for each timer that fires, when an earlier timer is scheduled,
+#   and every kMaxTimerWait seconds when nothing is due sooner.
+#
+################################################################################
+
+class TimerQueue(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+        self.timers = {}                # key -> (sequence, callback) of the live timer
+        self.sequence = itertools.count()
+        self.wakeRead, self.wakeWrite = os.pipe()
+        for fd in (self.wakeRead, self.wakeWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, key, due, callback):
+        with self.lock:
+            sequence = next(self.sequence)
+            self.timers[key] = (sequence, callback)
+            heapq.heappush(self.heap, (due, sequence, key))
+            earliest = self.heap[0][1] == sequence
+        if earliest:
+            self.wake()
+
+    def cancel(self, key):
+        with self.lock:
+            self.timers.pop(key, None)
+
+    def wake(self):
+        try:
+            os.write(self.wakeWrite, b"x")
+        except OSError as err:
+            if err.errno != errno.EAGAIN:   # a full pipe will wake the thread anyway
+                raise
+
+    def wait(self, maxWait):
+        with self.lock:
+            self.dropCancelled()
+            if self.heap:
+                maxWait = min(maxWait, self.heap[0][0] - time.time())
+        if maxWait > 0:
+            try:
+                select.select([self.wakeRead], [], [], maxWait)
+            except select.error as err:
+                if err.args[0] != errno.EINTR:
+                    raise
+        try:
+            while os.read(self.wakeRead, 4096):
+                pass
+        except OSError as err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def popDue(self, now):
+        due = []
+        with self.lock:
+            self.dropCancelled()
+            while self.heap and self.heap[0][0] <= now:
+                _, sequence, key = heapq.heappop(self.heap)
+                if self.timers.get(key, (None,))[0] == sequence:
+                    due.append((key, self.timers.pop(key)[1]))
+                self.dropCancelled()
+        return due
+
+    def dropCancelled(self):
+        while self.heap and self.timers.get(self.heap[0][2], (None,))[0] != self.heap[0][1]:
+            heapq.heappop(self.heap)
+
+
+################################################################################
+#
+#   Catalog of installed plugins for the ConfigUI list callbacks
+#
+#   Info.plist and Actions.xml are parsed once per bundle and only re-read when the
+#   Plugins folder or the bundle's files change (by mtime).  refresh() is run in the
+#   background so the dialog callbacks are just lookups.
+#
+################################################################################
+
+PluginInfo = namedtuple("PluginInfo", "bundleId name folder path actions actionFields signature")
+
+
+class PluginCatalog(object):
+
+    kPluginFolders = ['Plugins', 'Plugins (Disabled)']
+
+    def __init__(self, installPath):
+        self.installPath = installPath
+        self.lock = threading.Lock()
+        self.plugins = {}               # bundle path -> PluginInfo
+        self.bundles = {}               # bundleId -> PluginInfo of the enabled copy
+        self.folderTimes = None
+        self.loaded = False
+
+    def ensureLoaded(self):
+        if not self.loaded:
+            self.refresh()
+
+    def refresh(self):
+        with self.lock:
+            folderTimes = []
+            for pluginFolder in self.kPluginFolders:
+                try:
+                    folderTimes.append(os.stat(os.path.join(self.installPath, pluginFolder)).st_mtime)
+                except OSError:
+                    folderTimes.append(None)
+
+            if folderTimes != self.folderTimes:
+                bundlePaths = []
+                for pluginFolder in self.kPluginFolders:
+                    try:
+                        pluginsList = os.listdir(os.path.join(self.installPath, pluginFolder))
+                    except OSError:
+                        continue
+                    for plugin in pluginsList:
+                        # Check for Indigo Plugins and exclude 'system' plugins
+                        if (plugin.lower().endswith('.indigoplugin')) and (not plugin[0:1] == '.'):
+                            bundlePaths.append((pluginFolder, os.path.join(self.installPath, pluginFolder, plugin)))
+            else:
+                bundlePaths = [(info.folder, path) for path, info in self.plugins.iteritems()]
+
+            plugins = {}
+            for pluginFolder, path in bundlePaths:
+                signature = self.bundleSignature(path)
+                info = self.plugins.get(path)
+                if info is None or info.signature != signature:
+                    info = self.readBundle(pluginFolder, path, signature)
+                if info is not None:
+                    plugins[path] = info
+
+            self.plugins = plugins
+            # only enabled plugins, a disabled copy of the same bundle mustn't hide the enabled one
+            self.bundles = dict((info.bundleId, info) for info in plugins.itervalues() if info.folder == 'Plugins')
+            self.folderTimes = folderTimes
+            self.loaded = True
+
+    def bundleSignature(self, path):
+        signature = []
+        for fileName in ("Contents/Info.plist", "Contents/Server Plugin/Actions.xml"):
+            try:
+                signature.append(os.stat(os.path.join(path, fileName)).st_mtime)
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def readBundle(self, pluginFolder, path, signature):
+        plistPath = os.path.join(path, "Contents/Info.plist")
+        try:
+            pl = plistlib.readPlist(plistPath)
+            bundleId = pl["CFBundleIdentifier"]
+            name = pl["CFBundleDisplayName"]
+        except:
+            logger.warning(u"PluginCatalog: Unable to parse plist, skipping: %s" % (plistPath))
+            return None
+
+        actions = []
+        actionFields = {}
+        actionsPath = os.path.join(path, "Contents/Server Plugin/Actions.xml")
+        if signature[1] is not None:
+            try:
+                tree = ET.parse(actionsPath)
+            except:
+                logger.warning(u"PluginCatalog: Unable to parse Actions.xml for %s: %s" % (bundleId, actionsPath))
+            else:
+                for action in tree.getroot():
+                    if action.tag != "Action":
+                        continue
+                    actionId = action.attrib.get("id")
+                    actionName = action.find('Name')
+                    callBack = action.find('CallbackMethod')
+                    if actionName is not None and callBack is not None:
+                        actions.append((actionId, actionName.text))
+                    configUI = action.find('ConfigUI')
+                    if configUI is not None:
+                        actionFields[actionId] = [field.attrib["id"] for field in configUI
+                                                  if "id" in field.attrib and not bool(field.attrib.get("hidden", None))]
+
+        return PluginInfo(bundleId, name, pluginFolder, path, actions, actionFields, signature)
+
+    def pluginList(self, excludeId):
+        retList = []
+        for pluginFolder in self.kPluginFolders:
+            tempList = []
+            for info in self.plugins.itervalues():
+                if info.folder == pluginFolder and info.bundleId != excludeId:
+                    # if disabled plugins folder, append 'Disabled' to name
+                    tempList.append((info.bundleId, info.name + (' [Disabled]' if pluginFolder == 'Plugins (Disabled)' else '')))
+            tempList.sort(key=lambda tup: tup[1])
+            retList = retList + tempList
+        return retList
+
+    def enabledPlugin(self, bundleId):
+        return self.bundles.get(bundleId)
+
+    def actionList(self, bundleId):
+        info = self.enabledPlugin(bundleId)
+        return list(info.actions) if info else []
+
+    def actionFieldList(self, bundleId, actionId):
+        info = self.enabledPlugin(bundleId)
+        return list(info.actionFields.get(actionId, [])) if info else []
+
+
+################################################################################
+#
+#   Index of all Indigo devices for the ConfigUI device and state menus
+#
+#   Devices are grouped by device class ("indigo.zwave", ...) and by owning plugin,
+#   each group keeping a sorted (id, name) list that is rebuilt only after the group
+#   changes.  Built on first use, then kept current from deviceCreated / deviceUpdated /
+#   deviceDeleted.
+#
+################################################################################
+
+class DeviceIndex(object):
+
+    kProtocolClasses = {
+        indigo.kProtocol.Insteon:   "indigo.insteon",
+        indigo.kProtocol.ZWave:     "indigo.zwave",
+        indigo.kProtocol.X10:       "indigo.x10",
+    }
+
+    def __init__(self):
+        self.loaded = False
+        self.groups = {}                # group key -> {device id: name}
+        self.sortedGroups = {}          # group key -> sorted [(id, name)], dropped when the group changes
+        self.deviceGroups = {}          # device id -> tuple of group keys
+        self.stateKeys = {}             # device id -> sorted [(key, key)] of its states, for devices asked about, dropped on any update
+
+    def groupKeys(self, device):
+        if device.protocol == indigo.kProtocol.Plugin:
+            return (("plugin", device.pluginId),)
+        deviceClass = self.kProtocolClasses.get(device.protocol)
+        if deviceClass:
+            return (("class", deviceClass),)
+        return ()
+
+    def ensureLoaded(self):
+        if self.loaded:
+            return
+        for device in indigo.devices.iter():
+            self.add(device)
+        self.loaded = True
+
+    def add(self, device):
+        keys = self.groupKeys(device)
+        self.deviceGroups[device.id] = keys
+        for key in keys:
+            self.groups.setdefault(key, {})[device.id] = device.name
+            self.sortedGroups.pop(key, None)
+
+    def remove(self, deviceId):
+        for key in self.deviceGroups.pop(deviceId, ()):
+            self.groups.get(key, {}).pop(deviceId, None)
+            self.sortedGroups.pop(key, None)
+        self.stateKeys.pop(deviceId, None)
+
+    def update(self, oldDevice, newDevice):
+        self.stateKeys.pop(newDevice.id, None)      # stateList() filled it whether or not the index is loaded
+        if not self.loaded:
+            return
+        if oldDevice.name != newDevice.name or oldDevice.pluginId != newDevice.pluginId or oldDevice.protocol != newDevice.protocol:
+            self.remove(newDevice.id)
+            self.add(newDevice)
+
+    def deviceList(self, key):
+        self.ensureLoaded()
+        sortedGroup = self.sortedGroups.get(key)
+        if sortedGroup is None:
+            sortedGroup = sorted(self.groups.get(key, {}).iteritems(), key=lambda tup: tup[1])
+            self.sortedGroups[key] = sortedGroup
+        return sortedGroup
+
+    def stateList(self, deviceId):
+        stateKeys = self.stateKeys.get(deviceId)
+        if stateKeys is None:
+            stateKeys = self.sortedStateKeys(indigo.devices[deviceId])
+            self.stateKeys[deviceId] = stateKeys
+        return stateKeys
+
+    def sortedStateKeys(self, device):
+        return sorted((stateKey, stateKey) for stateKey in device.states.iterkeys())
+
+
+################################################################################
+#
+#   Action dispatcher
+#
+#   Actions on masquerade devices are queued per base device and sent by a small
+#   pool of worker threads, so a slow target plugin doesn't block Indigo's callback
+#   thread.  Commands for one base device run one at a time, in order.  A command
+#   submitted with a coalesce tag replaces a queued command with the same tag at the
+#   end of the queue, so a dragged slider only sends its latest level.
+#
+#   Commands can also name a group (the target plugin), which has at most groupLimit
+#   commands in flight.  Base devices whose next command is for a full group are
+#   parked without holding a worker, so a plugin that stops answering can't starve
+#   the others.  release(group) lets a group's parked commands run anyway, once its
+#   call in flight is known to be hung.
+#
+################################################################################
+
+class DispatchCommand(object):
+    __slots__ = ("function", "coalesce", "group", "queuedAt")
+
+    def __init__(self, function, coalesce, group):
+        self.function = function
+        self.coalesce = coalesce
+        self.group = group
+        self.queuedAt = time.time()
+
+
+class ActionDispatcher(object):
+
+    def __init__(self, workers, groupLimit):
+        self.workers = workers
+        self.groupLimit = groupLimit
+        self.condition = threading.Condition()
+        self.queues = {}                # key -> deque of DispatchCommand not yet started
+        self.ready = deque()            # keys with queued commands and nothing in flight
+        self.busy = set()               # keys with a command in flight
+        self.groupBusy = Counter()      # group -> commands in flight
+        self.parked = {}                # group -> deque of keys whose next command waits for the group
+        self.released = set()           # groups not limited until their commands in flight finish
+        self.threads = []
+        self.running = False
+        self.counters = Counter()
+        self.latencyTotal = 0.0
+        self.latencyMax = 0.0
+
+    def start(self):
+        self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.worker, name="MasqueradeDispatch-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join(1.0)
+        self.threads = []
+
+    def stats(self):
+        with self.condition:
+            dispatched = self.counters["dispatched"]
+            return {
+                "queueDepth":       sum(len(queue) for queue in self.queues.itervalues()),
+                "parked":           sum(len(keys) for keys in self.parked.itervalues()),
+                "submitted":        self.counters["submitted"],
+                "dispatched":       dispatched,
+                "coalesced":        self.counters["coalesced"],
+                "failed":           self.counters["failed"],
+                "latencyAvgMs":     (self.latencyTotal / dispatched * 1000.0) if dispatched else 0.0,
+                "latencyMaxMs":     self.latencyMax * 1000.0,
+            }
+
+    def resetStats(self):
+        with self.condition:
+            self.counters.clear()
+            self.latencyTotal = 0.0
+            self.latencyMax = 0.0
+
+    def submit(self, key, function, coalesce=None, group=None):
+        with self.condition:
+            self.counters["submitted"] += 1
+            queue = self.queues.setdefault(key, deque())
+            if coalesce is not None and queue and queue[-1].coalesce == coalesce and queue[-1].group == group:
+                queue[-1].function = function
+                self.counters["coalesced"] += 1
+                return
+            queue.append(DispatchCommand(function, coalesce, group))
+            if key not in self.busy and len(queue) == 1:
+                self.ready.append(key)
+                self.condition.notify()
+
+    def release(self, group):
+        with self.condition:
+            if not self.groupBusy[group]:
+                return
+            self.released.add(group)
+            self.ready.extend(self.parked.pop(group, ()))
+            self.condition.notify_all()
+
+    def nextCommand(self):
+        # (key, command) to run, parking keys whose group is full; None when stopping
+        while True:
+            while self.running and not self.ready:
+                self.condition.wait()
+            if not self.running:
+                return None
+            key = self.ready.popleft()
+            queue = self.queues[key]
+            group = queue[0].group
+            if group is not None and self.groupBusy[group] >= self.groupLimit and group not in self.released:
+                self.parked.setdefault(group, deque()).append(key)
+                continue
+            command = queue.popleft()
+            if not queue:
+                del self.queues[key]
+            self.busy.add(key)
+            if group is not None:
+                self.groupBusy[group] += 1
+            return key, command
+
+    def worker(self):
+        while True:
+            with self.condition:
+                taken = self.nextCommand()
+                if taken is None:
+                    return
+                key, command = taken
+
+            latency = time.time() - command.queuedAt
+            failed = False
+            try:
+                command.function()
+            except Exception as err:
+                failed = True
+                logger.exception(u"ActionDispatcher: command for device %s failed: %s", key, err)
+
+            with self.condition:
+                self.busy.discard(key)
+                self.counters["dispatched"] += 1
+                self.counters["failed"] += failed
+                self.latencyTotal += latency
+                self.latencyMax = max(self.latencyMax, latency)
+                if key in self.queues:
+                    self.ready.append(key)
+                    self.condition.notify()
+                if command.group is not None:
+                    self.groupDone(command.group)
+
+    def groupDone(self, group):
+        self.groupBusy[group] -= 1
+        if self.groupBusy[group] <= 0:
+            del self.groupBusy[group]
+            self.released.discard(group)
+        parked = self.parked.get(group)
+        if parked:
+            self.ready.append(parked.popleft())
+            if not parked:
+                del self.parked[group]
+            self.condition.notify()
+
+
+################################################################################
+#
+#   Target plugin handles and circuit breakers
+#
+#   indigo.server.getPlugin() handles are cached per bundle id for kPluginHandleTTL.
+#   After kBreakerThreshold consecutive failures (exceptions, a disabled plugin, or
+#   calls slower than kActionTimeout) the circuit opens and commands for that plugin
+#   are dropped for kBreakerCooldown.  Then one probe command is let through
+#   (half-open): success closes the circuit, failure opens it again.
+#
+#   Calls in flight are tracked by their start time, so a call that hangs counts as
+#   a failure once it has been out for kActionTimeout, without waiting for it to
+#   return.  While it is still out, further commands for the plugin are dropped and
+#   each counts as another failure.
+#
+################################################################################
+
+kCircuitClosed = "closed"
+kCircuitOpen = "open"
+kCircuitHalfOpen = "half-open"
+
+
+class PluginHandle(object):
+    __slots__ = ("plugin", "fetchedAt", "failures", "circuit", "openedAt", "calls", "hung")
+
+    def __init__(self):
+        self.plugin = None
+        self.fetchedAt = 0.0
+        self.failures = 0
+        self.circuit = kCircuitClosed
+        self.openedAt = 0.0
+        self.calls = {}                 # call token -> start time, for calls in flight
+        self.hung = set()               # tokens of calls in flight already counted as failures
+
+
+class PluginHandles(object):
+
+    def __init__(self, circuitChanged):
+        self.lock = threading.Lock()
+        self.handles = {}               # bundle id -> PluginHandle
+        self.tokens = itertools.count(1)
+        self.circuitChanged = circuitChanged
+
+    def handle(self, bundleId):
+        handle = self.handles.get(bundleId)
+        if handle is None:
+            handle = self.handles[bundleId] = PluginHandle()
+        return handle
+
+    def circuit(self, bundleId):
+        with self.lock:
+            handle = self.handles.get(bundleId)
+            return handle.circuit if handle else kCircuitClosed
+
+    def allow(self, bundleId):
+        # a call token if a command may be sent to the plugin now, else None.  Pass it to finish().
+        token = None
+        with self.lock:
+            handle = self.handle(bundleId)
+            now = time.time()
+            changed = self.countHung(handle, now)
+            if handle.hung:
+                changed = self.countFailure(handle, now) or changed     # fail fast behind a hung call
+            elif handle.circuit == kCircuitClosed:
+                token = self.startCall(handle, now)
+            elif handle.circuit == kCircuitOpen and now - handle.openedAt >= kBreakerCooldown:
+                handle.circuit = changed = kCircuitHalfOpen
+                token = self.startCall(handle, now)
+        if changed:
+            self.circuitChanged(bundleId, changed)
+        return token
+
+    def checkHung(self, bundleId):
+        # count calls that have been out for kActionTimeout as failures, True if there are any
+        with self.lock:
+            handle = self.handle(bundleId)
+            changed = self.countHung(handle, time.time())
+            hung = bool(handle.hung)
+        if changed:
+            self.circuitChanged(bundleId, changed)
+        return hung
+
+    def startCall(self, handle, now):
+        token = next(self.tokens)
+        handle.calls[token] = now
+        return token
+
+    def countHung(self, handle, now):
+        changed = None
+        for token, started in handle.calls.iteritems():
+            if token not in handle.hung and now - started > kActionTimeout:
+                handle.hung.add(token)
+                changed = self.countFailure(handle, now) or changed
+        return changed
+
+    def getPlugin(self, bundleId):
+        with self.lock:
+            handle = self.handle(bundleId)
+            if handle.plugin is not None and time.time() - handle.fetchedAt < kPluginHandleTTL:
+                return handle.plugin
+        plugin = indigo.server.getPlugin(bundleId)
+        with self.lock:
+            handle.plugin = plugin
+            handle.fetchedAt = time.time()
+        return plugin
+
+    def finish(self, bundleId, token, succeeded):
+        changed = None
+        with self.lock:
+            handle = self.handle(bundleId)
+            handle.calls.pop(token, None)
+            if token in handle.hung:
+                handle.hung.discard(token)  # already counted as a failure
+            elif not succeeded:
+                changed = self.countFailure(handle, time.time())
+            else:
+                handle.failures = 0
+                if handle.circuit != kCircuitClosed:
+                    handle.circuit = changed = kCircuitClosed
+        if changed:
+            self.circuitChanged(bundleId, changed)
+
+    def countFailure(self, handle, now):
+        # kCircuitOpen if this failure opened the circuit.  Called with the lock held.
+        handle.plugin = None                # fetch a fresh handle for the next attempt
+        handle.failures += 1
+        if handle.circuit == kCircuitOpen or (handle.circuit == kCircuitClosed and handle.failures < kBreakerThreshold):
+            return None
+        handle.circuit = kCircuitOpen
+        handle.openedAt = now
+        return kCircuitOpen
+
+
+class ThrottleState(object):
+    # what a throttled masquerade device last published, and the update waiting for its timer
+    __slots__ = ("lastValue", "lastTime", "pending")
+
+    def __init__(self):
+        self.lastValue = None
+        self.lastTime = 0.0
+        self.pending = None
+
+
+################################################################################
+#
+#   Rolling statistics
+#
+#   A fixed-size ring of (time, value) samples per device.  The sum is kept as samples
+#   come and go, and min / max come from monotonic deques of (sequence, value), so
+#   every statistic is O(1) per sample however long the window is.
+#
+################################################################################
+
+class RollingStats(object):
+
+    # only used under Plugin.updateLock
+
+    def __init__(self, window, capacity=kRollingCapacity):
+        self.window = window
+        self.capacity = capacity
+        self.times = array('d', [0.0] * capacity)
+        self.values = array('d', [0.0] * capacity)
+        self.next = 0                   # sequence number of the next sample, its slot is next % capacity
+        self.count = 0
+        self.total = 0.0
+        self.minimums = deque()         # (sequence, value), values increasing from the oldest
+        self.maximums = deque()         # (sequence, value), values decreasing from the oldest
+        self.lastChange = None
+
+    def add(self, now, value):
+        self.expire(now)
+        if self.count == self.capacity:
+            self.dropOldest()
+        slot = self.next % self.capacity
+        self.times[slot] = now
+        self.values[slot] = value
+        while self.minimums and self.minimums[-1][1] >= value:
+            self.minimums.pop()
+        self.minimums.append((self.next, value))
+        while self.maximums and self.maximums[-1][1] <= value:
+            self.maximums.pop()
+        self.maximums.append((self.next, value))
+        self.next += 1
+        self.count += 1
+        self.total += value
+        self.lastChange = now
+        if self.next % self.capacity == 0:
+            self.total = sum(self.values[(self.next - self.count + i) % self.capacity] for i in range(self.count))
+
+    def dropOldest(self):
+        oldest = self.next - self.count
+        self.total -= self.values[oldest % self.capacity]
+        self.count -= 1
+        if self.minimums[0][0] == oldest:
+            self.minimums.popleft()
+        if self.maximums[0][0] == oldest:
+            self.maximums.popleft()
+
+    def expire(self, now):
+        cutoff = now - self.window
+        while self.count > 1 and self.times[(self.next - self.count) % self.capacity] < cutoff:
+            self.dropOldest()
+
+    def states(self, now, decimalPlaces):
+        # the derived states for updateStatesOnServer, the latest sample always counts
+        self.expire(now)
+        if not self.count:
+            return []
+        oldest = (self.next - self.count) % self.capacity
+        newest = (self.next - 1) % self.capacity
+        elapsed = self.times[newest] - self.times[oldest]
+        rate = (self.values[newest] - self.values[oldest]) * 60.0 / elapsed if elapsed >= 1.0 else 0.0
+        return [{'key': 'rollingMin', 'value': round(self.minimums[0][1], decimalPlaces), 'decimalPlaces': decimalPlaces},
+                {'key': 'rollingMax', 'value': round(self.maximums[0][1], decimalPlaces), 'decimalPlaces': decimalPlaces},
+                {'key': 'rollingMean', 'value': round(self.total / self.count, decimalPlaces), 'decimalPlaces': decimalPlaces},
+                {'key': 'rateOfChange', 'value': round(rate, decimalPlaces + 1), 'decimalPlaces': decimalPlaces + 1},
+                {'key': 'minutesSinceChange', 'value': int((now - self.lastChange) / 60.0)}]
+
+
+################################################################################
+#
+#   Compiled mapping plans
+#
+#   Each masquerade device is compiled once (deviceStartComm or a props edit) into
+#   an immutable plan holding its parsed settings.  plan.apply(masqDeviceId, oldDevice,
+#   newDevice) returns (stateList, stateImage) for the masquerade device, or None if the
+#   base device change doesn't affect it.  stateList uses the updateStatesOnServer format.
+#
+################################################################################
+
+kSensorImages = {       # masqSensorSubtype: (image when on, image when off)
+    "Generic":          (indigo.kStateImageSel.None, indigo.kStateImageSel.None),
+    "MotionSensor":     (indigo.kStateImageSel.MotionSensorTripped, indigo.kStateImageSel.MotionSensor),
+    "Power":            (indigo.kStateImageSel.PowerOn, indigo.kStateImageSel.PowerOff),
+}
+
+kValueSensorFormats = { # masqSensorSubtype: (image, decimalPlaces, uiValue suffix)
+    "Generic":          (indigo.kStateImageSel.None, None, None),
+    "Temperature-F":    (indigo.kStateImageSel.TemperatureSensor, 1, u' °F'),
+    "Temperature-C":    (indigo.kStateImageSel.TemperatureSensor, 1, u' °C'),
+    "Humidity":         (indigo.kStateImageSel.HumiditySensor, 0, u'%'),
+    "Luminance":        (indigo.kStateImageSel.LightSensor, 0, u' lux'),
+    "Luminance%":       (indigo.kStateImageSel.LightSensor, 0, u'%'),
+    "Luminence":        (indigo.kStateImageSel.LightSensor, 0, u' lux'),    # misspelled ids used by older versions
+    "Luminence%":       (indigo.kStateImageSel.LightSensor, 0, u'%'),
+    "Energy":           (indigo.kStateImageSel.EnergyMeterOn, 0, u' watts'),
+    "ppm":              (indigo.kStateImageSel.None, 0, u'ppm'),
+}
+
+kValueFormatters = {
+    "Decimal":          lambda value: str(value),
+    "Hexidecimal":      lambda value: '{:02x}'.format(value),
+    "Octal":            lambda value: oct(value),
+}
+
+
+################################################################################
+#
+#   Scaling transforms
+#
+#   A dimmer's 0-100% brightness maps onto the base device's integer range through
+#   a curve: linear, gamma, piecewise-linear points or an explicit value table.  The
+#   curve is evaluated once when the plan is compiled, into an inverse table (percent
+#   -> base value and its formatted string) and a forward table (base value -> the
+#   percent nearest to it), so both directions are lookups.  forward(inverse(p)) == p
+#   only where the curve gives p a base value of its own.  When several percents round
+#   to the same value, as with narrow limits or the low end of a gamma curve, forward
+#   returns the one whose exact curve value is closest.
+#
+################################################################################
+
+kTransformTypes = ("linear", "gamma", "piecewise", "table")
+kMaxForwardTable = 65536    # wider base ranges search the inverse table instead of precomputing
+
+
+def parsePoints(pointsProp, key):
+    # "percent:value, ..." -> [(percent, value)] sorted on percent
+    points = []
+    for point in pointsProp.split(u","):
+        if not point.strip():
+            continue
+        percent, _, value = point.partition(u":")
+        try:
+            points.append((float(percent), float(value)))
+        except ValueError:
+            raise PropError(key, u"Enter points as percent:value, separated by commas")
+        if not 0.0 <= points[-1][0] <= 100.0:
+            raise PropError(key, u"Point percentages must be between 0 and 100")
+    if not points:
+        raise PropError(key, u"Enter at least one percent:value point")
+    points.sort()
+    return points
+
+
+def piecewiseCurve(points):
+    # points are (percent, percent of the limit range), joined by straight lines
+    xs = [percent / 100.0 for percent, value in points]
+    ys = [value / 100.0 for percent, value in points]
+
+    def curve(fraction):
+        i = bisect.bisect_right(xs, fraction)
+        if i == 0:
+            return ys[0]
+        elif i == len(xs):
+            return ys[-1]
+        return ys[i - 1] + (ys[i] - ys[i - 1]) * (fraction - xs[i - 1]) / (xs[i] - xs[i - 1])
+    return curve
+
+
+class Transform(object):
+
+    def __init__(self, exact, formatter):
+        # exact: the unrounded base value for each percent 0..100
+        self.inverse = tuple(int(round(value)) for value in exact)
+        self.inverseStrings = tuple(formatter(value) for value in self.inverse)
+        self.low = min(self.inverse)
+        self.high = max(self.inverse)
+
+        # percents that round to the same base value: keep the one whose exact value is closest
+        self.values = []
+        self.percents = []
+        for value, error, percent in sorted((value, abs(exact[percent] - value), percent) for percent, value in enumerate(self.inverse)):
+            if not self.values or self.values[-1] != value:
+                self.values.append(value)
+                self.percents.append(percent)
+
+        self.forwardTable = None
+        if self.high - self.low < kMaxForwardTable:
+            self.forwardTable = tuple(self.nearest(value) for value in xrange(self.low, self.high + 1))
+
+    def nearest(self, value):
+        i = bisect.bisect_left(self.values, value)
+        if i == len(self.values):
+            return self.percents[-1]
+        if i == 0 or self.values[i] == value:
+            return self.percents[i]
+        if value - self.values[i - 1] <= self.values[i] - value:
+            return self.percents[i - 1]
+        return self.percents[i]
+
+    def forward(self, value):
+        # base value within [low, high] -> percent
+        if self.forwardTable is not None:
+            return self.forwardTable[value - self.low]
+        return self.nearest(value)
+
+    def inverseString(self, percent):
+        return self.inverseStrings[min(100, max(0, int(percent)))]
+
+
+def compileTransform(props, low, high, reverse, formatter):
+    transformType = props.get("transformType", "linear")
+    if transformType == "table":
+        # each value applies from its percent up to the next point, limits and reverse don't apply
+        points = parsePoints(props.get("transformPoints", u""), "transformPoints")
+        exact = []
+        for percent in range(101):
+            i = bisect.bisect_right(points, (percent, float("inf")))
+            exact.append(points[max(0, i - 1)][1])
+        return Transform(exact, formatter)
+
+    if transformType == "linear":
+        curve = lambda fraction: fraction
+    elif transformType == "gamma":
+        gamma = propFloat(props, "transformGamma", 1.0)
+        if gamma == 0:
+            raise PropError("transformGamma", u"Must be greater than zero")
+        curve = lambda fraction: fraction ** gamma
+    elif transformType == "piecewise":
+        curve = piecewiseCurve(parsePoints(props.get("transformPoints", u""), "transformPoints"))
+    else:
+        raise PropError("transformType", u"Unknown scaling curve: %s" % transformType)
+
+    exact = []
+    for percent in range(101):
+        fraction = min(1.0, max(0.0, curve(percent / 100.0)))
+        if reverse:
+            fraction = 1.0 - fraction
+        exact.append(low + fraction * (high - low))
+    return Transform(exact, formatter)
+
+
+class SensorPlan(namedtuple("SensorPlan", "masqState matchString reverse imageOn imageOff onDelay offDelay")):
+
+    @property
+    def throttled(self):
+        return self.onDelay > 0 or self.offDelay > 0
+
+    def apply(self, masqDeviceId, oldDevice, newDevice):
+        value = newDevice.states[self.masqState]
+        if oldDevice is not None and oldDevice.states[self.masqState] == value:
+            return None
+        match = (str(value) == self.matchString) != self.reverse
+        return ([{'key': 'onOffState', 'value': match}], self.imageOn if match else self.imageOff)
+
+
+class ValueSensorPlan(namedtuple("ValueSensorPlan", "masqState image decimalPlaces uiSuffix deadbandAbs deadbandPct minInterval history")):
+    # history: RollingStats when rolling statistics are on, else None
+
+    @property
+    def throttled(self):
+        return self.deadbandAbs > 0 or self.deadbandPct > 0 or self.minInterval > 0
+
+    def inDeadband(self, value, lastValue):
+        return abs(value - lastValue) < max(self.deadbandAbs, abs(lastValue) * self.deadbandPct / 100.0)
+
+    def apply(self, masqDeviceId, oldDevice, newDevice):
+        value = newDevice.states[self.masqState]
+        if oldDevice is not None and oldDevice.states[self.masqState] == value:
+            return None
+        baseValue = float(value)
+        state = {'key': 'sensorValue', 'value': baseValue}
+        if self.uiSuffix is not None:
+            state['decimalPlaces'] = self.decimalPlaces
+            state['uiValue'] = str(baseValue) + self.uiSuffix
+        if self.history is None:
+            return ([state], self.image)
+        now = time.time()
+        self.history.add(now, baseValue)
+        return ([state] + self.history.states(now, self.statsDecimalPlaces), self.image)
+
+    @property
+    def statsDecimalPlaces(self):
+        return self.decimalPlaces if self.decimalPlaces is not None else 2
+
+    def refreshUpdate(self, now):
+        # derived states as they stand now, for windows that have aged without new samples
+        return (self.history.states(now, self.statsDecimalPlaces), None)
+
+
+class DimmerPlan(namedtuple("DimmerPlan", "masqState stateTransform actionTransform optimistic confirmTimeout")):
+    throttled = False
+
+    def apply(self, masqDeviceId, oldDevice, newDevice):
+        value = newDevice.states[self.masqState]
+        if oldDevice is not None and oldDevice.states[self.masqState] == value:
+            return None
+        scaledValue = self.scaleBaseToMasq(masqDeviceId, newDevice.name, int(value))
+        return ([{'key': 'brightnessLevel', 'value': scaledValue}], None)
+
+    def scaleBaseToMasq(self, masqDeviceId, name, input):
+        transform = self.stateTransform
+        if input < transform.low:
+            limitedLog.warning((masqDeviceId, "scaleBaseToMasq"), u"scaleBaseToMasq: Input value for %s is lower than expected: %d", name, input)
+            input = transform.low
+        elif input > transform.high:
+            limitedLog.warning((masqDeviceId, "scaleBaseToMasq"), u"scaleBaseToMasq: Input value for %s is higher than expected: %d", name, input)
+            input = transform.high
+        return transform.forward(input)
+
+    def scaleMasqToBase(self, input):
+        return self.actionTransform.inverseString(input)
+
+    def echoBrightness(self, baseValue):
+        # the brightness the base device's report of baseValue will show as
+        transform = self.stateTransform
+        return transform.forward(min(transform.high, max(transform.low, int(baseValue))))
+
+
+class SpeedControlPlan(namedtuple("SpeedControlPlan", "scaleFactor brightnessTable")):
+    # brightnessTable: base dimmer brightness for each speed value 0..100
+    throttled = False
+
+    def apply(self, masqDeviceId, oldDevice, newDevice):
+        if oldDevice is not None and oldDevice.brightness == newDevice.brightness:
+            return None
+        baseValue = newDevice.brightness    # convert this to a speedIndex?
+        return ([{'key': 'speedLevel', 'value': baseValue}], None)
+
+    def baseBrightness(self, speed):
+        return self.brightnessTable[min(100, max(0, int(speed)))]
+
+
+class SprinklerPlan(namedtuple("SprinklerPlan", "")):
+    throttled = False
+
+    def apply(self, masqDeviceId, oldDevice, newDevice):
+        if oldDevice is not None and oldDevice.onState == newDevice.onState:
+            return None
+        return ([{'key': 'activeZone', 'value': (1 if newDevice.onState else 0)}], None)
+
+
+################################################################################
+#
+#   Aggregate masquerades
+#
+#   A masqAggregate device combines one state from each of several base devices.
+#   The Aggregator keeps running totals so a source change costs O(1) (sum, mean,
+#   counts) or O(log n) (min / max, a heap with lazily dropped stale entries),
+#   instead of re-reading every source.
+#
+################################################################################
+
+kAggregateFunctions = ("min", "max", "mean", "sum", "countTrue", "any", "all")
+kNumericAggregates = ("min", "max", "mean", "sum")
+kAggregateResync = 1000     # updates between exact re-sums, to stop float drift in the running sum
+
+
+def parseSources(sourcesProp):
+    # "baseDeviceId:stateKey,..." -> [(baseDeviceId, stateKey)]
+    sources = []
+    for source in sourcesProp.split(u","):
+        baseDeviceId, _, stateKey = source.strip().partition(u":")
+        if baseDeviceId and stateKey:
+            sources.append((int(baseDeviceId), stateKey))
+    return sources
+
+
+def formatSources(sources):
+    return u",".join(u"%d:%s" % source for source in sources)
+
+
+class Aggregator(object):
+
+    # only used under Plugin.updateLock
+
+    def __init__(self, function, matchString):
+        self.function = function
+        self.matchString = matchString
+        self.values = {}                # (baseDeviceId, stateKey) -> (value, version)
+        self.version = 0
+        self.total = 0.0
+        self.trueCount = 0
+        self.updates = 0
+        self.heap = []                  # (sort value, version, source), for min / max only
+
+    def convert(self, value):
+        if self.function in kNumericAggregates:
+            return float(value)
+        if self.matchString:
+            return str(value) == self.matchString
+        if isinstance(value, basestring):
+            return value.strip().lower() in (u"true", u"on", u"yes", u"1")
+        return bool(value)
+
+    def set(self, source, rawValue):
+        try:
+            value = self.convert(rawValue)
+        except (TypeError, ValueError):
+            logger.debug(u"Aggregator: ignoring non-numeric value %s for %s", rawValue, source)
+            self.remove(source)
+            return
+        self.remove(source)
+        self.version += 1
+        self.values[source] = (value, self.version)
+        self.total += value
+        self.trueCount += bool(value)
+        if self.function == "min":
+            heapq.heappush(self.heap, (value, self.version, source))
+        elif self.function == "max":
+            heapq.heappush(self.heap, (-value, self.version, source))
+        self.updates += 1
+        if self.updates % kAggregateResync == 0:
+            self.total = sum(value for value, version in self.values.itervalues())
+            if len(self.heap) > 2 * len(self.values) + 16:
+                self.rebuildHeap()
+
+    def remove(self, source):
+        old = self.values.pop(source, None)
+        if old is not None:
+            self.total -= old[0]
+            self.trueCount -= bool(old[0])
+
+    def rebuildHeap(self):
+        sign = 1 if self.function == "min" else -1
+        self.heap = [(sign * value, version, source) for source, (value, version) in self.values.iteritems()]
+        heapq.heapify(self.heap)
+
+    def result(self):
+        # None until at least one source has a value
+        count = len(self.values)
+        if self.function in ("min", "max"):
+            while self.heap and self.values.get(self.heap[0][2], (None, None))[1] != self.heap[0][1]:
+                heapq.heappop(self.heap)
+            if not self.heap:
+                return None
+            return self.heap[0][0] if self.function == "min" else -self.heap[0][0]
+        if count == 0:
+            return None
+        if self.function == "mean":
+            return self.total / count
+        elif self.function == "sum":
+            return self.total
+        elif self.function == "countTrue":
+            return self.trueCount
+        elif self.function == "any":
+            return self.trueCount > 0
+        return self.trueCount == count
+
+
+class AggregatePlan(namedtuple("AggregatePlan", "sources function image decimalPlaces uiSuffix aggregator")):
+    # sources: {baseDeviceId: (stateKey, ...)}.  aggregator holds the running state.
+    throttled = False
+
+    def apply(self, masqDeviceId, oldDevice, newDevice):
+        changed = False
+        for stateKey in self.sources.get(newDevice.id, ()):
+            if stateKey not in newDevice.states:
+                continue
+            value = newDevice.states[stateKey]
+            if oldDevice is None or oldDevice.states.get(stateKey) != value:
+                self.aggregator.set((newDevice.id, stateKey), value)
+                changed = True
+        if not changed:
+            return None
+        return self.resultUpdate()
+
+    def removeBase(self, baseDeviceId):
+        for stateKey in self.sources.get(baseDeviceId, ()):
+            self.aggregator.remove((baseDeviceId, stateKey))
+        return self.resultUpdate()
+
+    def resultUpdate(self):
+        result = self.aggregator.result()
+        if result is None:
+            return None
+        if self.function in ("any", "all"):
+            return ([{'key': 'onOffState', 'value': result}, {'key': 'sensorValue', 'value': 1 if result else 0}],
+                    indigo.kStateImageSel.SensorOn if result else indigo.kStateImageSel.SensorOff)
+        if self.function == "countTrue":
+            return ([{'key': 'sensorValue', 'value': result, 'decimalPlaces': 0, 'uiValue': str(result)}], self.image)
+        decimalPlaces = self.decimalPlaces if self.decimalPlaces is not None else 2
+        uiValue = u"%.*f" % (decimalPlaces, result) + (self.uiSuffix or u"")
+        return ([{'key': 'sensorValue', 'value': round(result, decimalPlaces), 'decimalPlaces': decimalPlaces, 'uiValue': uiValue}], self.image)
+
+
+def baseDeviceIds(deviceTypeId, props):
+    # the base devices a masquerade device follows
+    if deviceTypeId == "masqAggregate":
+        return tuple(sorted(set(baseDeviceId for baseDeviceId, stateKey in parseSources(props.get("aggregateSources", u"")))))
+    return (int(props["baseDevice"]),)
+
+
+def staleTimeout(props):
+    # seconds without a base device update before the masquerade is marked stale, 0 when not watched
+    return propFloat(props, "staleTimeout") * 60.0
+
+
+def compilePlan(deviceTypeId, props):
+    # raises KeyError or ValueError if the props can't be compiled
+
+    if deviceTypeId == "masqSensor":
+        imageOn, imageOff = kSensorImages[props["masqSensorSubtype"]]
+        return SensorPlan(props["masqState"], props.get("matchString", ""), propBool(props.get("reverse", False)), imageOn, imageOff,
+                          propFloat(props, "onDelay"), propFloat(props, "offDelay"))
+
+    elif deviceTypeId == "masqValueSensor":
+        image, decimalPlaces, uiSuffix = kValueSensorFormats[props["masqSensorSubtype"]]
+        history = None
+        if propBool(props.get("rollingStats", False)):
+            window = propFloat(props, "rollingWindow", 60.0)
+            if window <= 0:
+                raise PropError("rollingWindow", u"Must be greater than zero")
+            history = RollingStats(window * 60.0)
+        return ValueSensorPlan(props["masqState"], image, decimalPlaces, uiSuffix,
+                               propFloat(props, "deadbandAbs"), propFloat(props, "deadbandPct"), propFloat(props, "minInterval"), history)
+
+    elif deviceTypeId == "masqDimmer":
+        lowLimitState, highLimitState = propInt(props, "lowLimitState", 0), propInt(props, "highLimitState", 100)
+        if highLimitState <= lowLimitState:
+            raise PropError("highLimitState", u"High Limit must be greater than Low Limit")
+        formatter = kValueFormatters[props.get("masqValueFormat", "Decimal")]
+        optimistic = propBool(props.get("optimisticUpdates", False))
+        confirmTimeout = propFloat(props, "confirmTimeout", 10.0)
+        if optimistic and confirmTimeout <= 0:
+            raise PropError("confirmTimeout", u"Must be greater than zero")
+        return DimmerPlan(props["masqState"],
+                          compileTransform(props, lowLimitState, highLimitState, propBool(props.get("reverseState", False)), kValueFormatters["Decimal"]),
+                          compileTransform(props, propInt(props, "lowLimitAction", 0), propInt(props, "highLimitAction", 100),
+                                           propBool(props.get("reverseAction", False)), formatter),
+                          optimistic, confirmTimeout)
+
+    elif deviceTypeId == "masqSpeedControl":
+        scaleFactor = propInt(props, "scaleFactor", 25)
+        return SpeedControlPlan(scaleFactor, tuple(min(100, max(0, speed * scaleFactor)) for speed in range(101)))
+
+    elif deviceTypeId == "masqSprinkler":
+        return SprinklerPlan()
+
+    elif deviceTypeId == "masqAggregate":
+        function = props.get("aggregateFunction", "mean")
+        if function not in kAggregateFunctions:
+            raise PropError("aggregateFunction", u"Unknown aggregate function: %s" % function)
+        try:
+            sourceList = parseSources(props.get("aggregateSources", u""))
+        except ValueError:
+            raise PropError("sourceList", u"Invalid source list")
+        if not sourceList:
+            raise PropError("sourceList", u"Add at least one source")
+        sources = {}
+        for baseDeviceId, stateKey in sourceList:
+            sources[baseDeviceId] = sources.get(baseDeviceId, ()) + (stateKey,)
+        image, decimalPlaces, uiSuffix = kValueSensorFormats[props.get("masqSensorSubtype", "Generic")]
+        return AggregatePlan(sources, function, image, decimalPlaces, uiSuffix, Aggregator(function, props.get("matchString", u"")))
+
+    raise KeyError(deviceTypeId)
+
+
+################################################################################
+#
+#   Performance statistics
+#
+#   Counters live in Plugin.counters (updated under updateLock), timings here.  Both
+#   are shown by the "Show Performance Stats" menu item and saved by the
+#   dumpPerfStats action.
+#
+################################################################################
+
+class TimingStats(object):
+
+    # name -> [count, total seconds, max seconds], added to from the callback, timer and dispatch threads
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+
+    def add(self, name, seconds):
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                self.timings[name] = [1, seconds, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+                if seconds > timing[2]:
+                    timing[2] = seconds
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+
+    def snapshot(self):
+        with self.lock:
+            return dict((name, {"count": count, "avgMs": total / count * 1000.0, "maxMs": maximum * 1000.0})
+                        for name, (count, total, maximum) in self.timings.iteritems())
+
+
+def timedCallback(method):
+    # records how long a ConfigUI callback takes under "configUI <method name>"
+    name = u"configUI " + method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        startTime = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.timings.add(name, time.time() - startTime)
+    return wrapper
+
+
+################################################################################
+#
+#   Event trace
+#
+#   While tracing, every deviceUpdated for a masqueraded device and every action
+#   callback is appended to a JSON lines file.  The trace starts with "base" and
+#   "masq" records holding the devices involved, so benchmarks/replay_trace.py can
+#   rebuild them against the stub indigo module and replay the events.
+#
+################################################################################
+
+class TraceRecorder(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.traceFile = open(path, "a")
+        self.records = 0
+        self.baseIds = set()            # base devices already recorded
+
+    def record(self, recordType, **fields):
+        fields["type"] = recordType
+        fields["t"] = round(time.time(), 3)
+        line = json.dumps(fields, sort_keys=True, default=unicode)
+        with self.lock:
+            if self.traceFile is None:
+                return
+            self.traceFile.write(line + "\n")
+            self.records += 1
+
+    def recordBase(self, device):
+        if device.id in self.baseIds:
+            return
+        self.baseIds.add(device.id)
+        self.record("base", id=device.id, name=device.name, pluginId=device.pluginId, protocol=str(device.protocol),
+                    states=dict(device.states))
+
+    def recordMasq(self, device):
+        self.record("masq", id=device.id, name=device.name, deviceTypeId=device.deviceTypeId,
+                    props=dict(device.pluginProps), states=dict(device.states))
+
+    def recordUpdate(self, oldDevice, newDevice):
+        changed = dict((key, value) for key, value in newDevice.states.iteritems() if oldDevice.states.get(key) != value)
+        if changed:
+            self.record("update", id=newDevice.id, states=changed)
+
+    def recordAction(self, kind, action, dev, command):
+        self.record("action", kind=kind, id=dev.id, action=str(command), value=getattr(action, "actionValue", None))
+
+    def close(self):
+        with self.lock:
+            if self.traceFile is not None:
+                self.traceFile.close()
+                self.traceFile = None
 
-kCurDevVersCount = 0        # current version of plugin devices
 
 ################################################################################
 class Plugin(indigo.PluginBase):
@@ -22,58 +1397,327 @@ class Plugin(indigo.PluginBase):
     def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
         indigo.PluginBase.__init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs)
 
-        pfmt = logging.Formatter('%(asctime)s.%(msecs)03d\t[%(levelname)8s] %(name)20s.%(funcName)-25s%(msg)s', datefmt='%Y-%m-%d %H:%M:%S')
+        pfmt = logging.Formatter('%(asctime)s.%(msecs)03d\t[%(levelname)8s] %(name)20s.%(funcName)-25s%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
         self.plugin_file_handler.setFormatter(pfmt)
 
         try:
-            self.logLevel = int(self.pluginPrefs[u"logLevel"])
+            self.setLogLevel(int(self.pluginPrefs[u"logLevel"]))
         except:
-            self.logLevel = logging.INFO
-        self.indigo_log_handler.setLevel(self.logLevel)
+            self.setLogLevel(logging.INFO)
         self.logger.debug(u"logLevel = " + str(self.logLevel))
 
+    def setLogLevel(self, logLevel):
+        # debug messages are only built when Debugging is selected, the plugin log file doesn't get them otherwise
+        self.logLevel = logLevel
+        self.indigo_log_handler.setLevel(logLevel)
+        self.logger.setLevel(min(logLevel, logging.INFO))
+
 
     def startup(self):
         indigo.server.log(u"Starting Masquerade")
         self.masqueradeList = {}
+        self.baseIndex = {}         # base device id -> set of masquerade device ids
+        self.masqPlans = {}         # masquerade device id -> compiled mapping plan
+        self.indexedBases = {}      # masquerade device id -> base device ids it is indexed under
+        self.pendingWrites = {}     # masquerade device id -> (device, stateList, stateImage) waiting for flushWrites()
+        self.lastWritten = {}       # masquerade device id -> {state key: (value, uiValue)} as last written
+        self.stateImages = {}       # masquerade device id -> state image last written
+        self.reconcilePending = set()   # started masquerade devices waiting for reconcileDevices()
+        self.trace = None           # TraceRecorder while an event trace is running
+        self.counters = Counter()
+        self.timings = TimingStats()
+        self.statsSince = time.time()
+        self.timingKeys = {}        # masquerade device id -> "updateDevice <type>/<subtype>" timing name
+        self.throttles = {}         # masquerade device id -> ThrottleState
+        self.expectations = {}      # masquerade device id -> brightness written optimistically, until the base device confirms it
+        self.staleTimeouts = {}     # watched masquerade device id -> seconds its base devices may stay silent
+        self.lastSeen = {}          # watched masquerade device id -> time of the last base device update
+        self.staleDevices = set()   # watched masquerade devices currently showing the stale error
+        self.timers = TimerQueue()
+        self.updateLock = threading.RLock()     # taken by anything that writes masquerade states
+        self.catalog = PluginCatalog(indigo.server.getInstallFolderPath())
+        self.deviceIndex = DeviceIndex()
+        self.pluginHandles = PluginHandles(self.circuitChanged)
+        self.dispatcher = ActionDispatcher(kDispatchWorkers, kMaxPluginCalls)
+        self.dispatcher.start()
+        self.timers.schedule("catalog", time.time(), self.refreshCatalog)
+        self.timers.schedule("warnings", time.time() + kWarningInterval, self.flushWarnings)
+        self.timers.schedule("rolling", time.time() + kRollingRefresh, self.refreshRollingStats)
         indigo.devices.subscribeToChanges()
 
     def shutdown(self):
         indigo.server.log(u"Shutting down Masquerade")
+        self.dispatcher.stop()
+        if self.trace is not None:
+            self.stopEventTrace()
+        self.logger.debug(u"Action dispatch: %s" % (self.dispatcher.stats()))
+        self.logger.debug(u"State writes issued: %d, suppressed as unchanged: %d, filtered by deadband: %d" %
+                          (self.counters["writesIssued"], self.counters["writesSuppressed"], self.counters["deadbandFiltered"]))
+
+    def runConcurrentThread(self):
+        try:
+            while True:
+                for key, callback in self.timers.popDue(time.time()):
+                    try:
+                        callback()
+                    except Exception as err:
+                        self.logger.exception(u"runConcurrentThread: timer %s failed: %s" % (str(key), err))
+                self.timers.wait(kMaxTimerWait)
+                if self.stopThread:
+                    raise self.StopThread
+        except self.StopThread:
+            pass
+
+    def refreshCatalog(self):
+        self.catalog.refresh()
+        self.timers.schedule("catalog", time.time() + kCatalogRefresh, self.refreshCatalog)
+
+    def refreshRollingStats(self):
+        # age the rolling statistics of devices whose base hasn't changed, unchanged states aren't written
+        now = time.time()
+        with self.updateLock:
+            for masqDeviceId, plan in self.masqPlans.items():
+                if isinstance(plan, ValueSensorPlan) and plan.history is not None and plan.history.count:
+                    self.queueWrite(self.masqueradeList[masqDeviceId], *plan.refreshUpdate(now))
+            self.flushWrites()
+        self.timers.schedule("rolling", time.time() + kRollingRefresh, self.refreshRollingStats)
+
+    def flushWarnings(self):
+        limitedLog.flush()
+        self.timers.schedule("warnings", time.time() + kWarningInterval, self.flushWarnings)
+
+    def stopConcurrentThread(self):
+        indigo.PluginBase.stopConcurrentThread(self)
+        self.timers.wake()
 
 
     def deviceStartComm(self, device):
 
         instanceVers = int(device.pluginProps.get('devVersCount', 0))
         if instanceVers >= kCurDevVersCount:
-            self.logger.debug(device.name + u": Device Version is up to date")
+            self.logger.debug(u"%s: Device Version is up to date", device.name)
         elif instanceVers < kCurDevVersCount:
             newProps = device.pluginProps
 
             newProps["devVersCount"] = kCurDevVersCount
             device.replacePluginPropsOnServer(newProps)
             device.stateListOrDisplayStateIdChanged()
-            self.logger.debug(u"Updated " + device.name + " to version " + str(kCurDevVersCount))
+            self.logger.debug(u"Updated %s to version %d", device.name, kCurDevVersCount)
         else:
             self.logger.error(u"Unknown device version: " + str(instanceVers) + " for device " + device.name)
 
-        self.logger.debug("Adding Device %s (%d) to device list" % (device.name, device.id))
+        self.logger.debug(u"Adding Device %s (%d) to device list", device.name, device.id)
         assert device.id not in self.masqueradeList
         self.masqueradeList[device.id] = device
-        baseDevice = indigo.devices[int(device.pluginProps["baseDevice"])]
-        self.updateDevice(device, None, baseDevice)
+        if self.trace is not None:
+            self.traceMasqDevice(device)
+        if device.errorState:
+            device.setErrorStateOnServer(None)      # left over from before the restart, the watchdog sets it again if needed
+        self.compileMasqPlan(device)
+        self.addToBaseIndex(device)
+        self.seedWriteCache(device)
+        with self.updateLock:
+            if not self.reconcilePending:
+                self.timers.schedule("reconcile", time.time() + kReconcileDelay, self.reconcileDevices)
+            self.reconcilePending.add(device.id)
 
 
     def deviceStopComm(self, device):
-        self.logger.debug("Removing Device %s (%d) from device list" % (device.name, device.id))
+        self.logger.debug(u"Removing Device %s (%d) from device list", device.name, device.id)
         assert device.id in self.masqueradeList
-        del self.masqueradeList[device.id]
+        with self.updateLock:
+            self.removeFromBaseIndex(device.id)
+            del self.masqueradeList[device.id]
+            self.masqPlans.pop(device.id, None)
+            self.timingKeys.pop(device.id, None)
+            self.pendingWrites.pop(device.id, None)
+            self.lastWritten.pop(device.id, None)
+            self.stateImages.pop(device.id, None)
+            self.throttles.pop(device.id, None)
+            self.reconcilePending.discard(device.id)
+            self.expectations.pop(device.id, None)
+            self.staleTimeouts.pop(device.id, None)
+            self.lastSeen.pop(device.id, None)
+            self.staleDevices.discard(device.id)
+            self.timers.cancel(("throttle", device.id))
+            self.timers.cancel(("confirm", device.id))
+            self.timers.cancel(("stale", device.id))
+
+
+    ########################################
+    # Base device index
+    ########################################
+
+    def addToBaseIndex(self, masqDevice):
+        try:
+            baseIds = baseDeviceIds(masqDevice.deviceTypeId, masqDevice.pluginProps)
+        except (KeyError, ValueError):
+            self.logger.error(u"%s: no device selected to masquerade" % (masqDevice.name))
+            return
+        self.indexedBases[masqDevice.id] = baseIds
+        for baseDeviceId in baseIds:
+            self.baseIndex.setdefault(baseDeviceId, set()).add(masqDevice.id)
+
+    def removeFromBaseIndex(self, masqDeviceId):
+        for baseDeviceId in self.indexedBases.pop(masqDeviceId, ()):
+            masqIds = self.baseIndex.get(baseDeviceId)
+            if masqIds is not None:
+                masqIds.discard(masqDeviceId)
+                if not masqIds:
+                    del self.baseIndex[baseDeviceId]
+
+    def refreshMasqDevice(self, newDevice):
+        # keep our copy of a masquerade device current, and re-index it if the props were edited
+        oldDevice = self.masqueradeList[newDevice.id]
+        self.masqueradeList[newDevice.id] = newDevice
+        if dict(oldDevice.pluginProps) == dict(newDevice.pluginProps):
+            return
+        if self.trace is not None:
+            self.traceMasqDevice(newDevice)
+        self.compileMasqPlan(newDevice)
+        self.removeFromBaseIndex(newDevice.id)
+        self.addToBaseIndex(newDevice)
+        self.logger.debug(u"refreshMasqDevice: %s now masquerades devices %s", newDevice.name, self.indexedBases.get(newDevice.id))
+        self.syncMasqDevice(newDevice)
+
+    def syncMasqDevice(self, masqDevice, baseDevices=None):
+        # bring a masquerade device up to date with all of its base devices
+        # baseDevices: optional {base device id: device} cache shared across a batch of syncs
+        if baseDevices is None:
+            baseDevices = {}
+        with self.updateLock:
+            for baseDeviceId in self.indexedBases.get(masqDevice.id, ()):
+                baseDevice = baseDevices.get(baseDeviceId)
+                if baseDevice is None:
+                    try:
+                        baseDevice = baseDevices[baseDeviceId] = indigo.devices[baseDeviceId]
+                    except KeyError:
+                        limitedLog.warning((masqDevice.id, "missingBase"), u"%s: masqueraded device %d does not exist", masqDevice.name, baseDeviceId)
+                        continue
+                self.updateDevice(masqDevice, None, baseDevice)
+            if self.usesPluginAction(masqDevice):
+                self.queueWrite(masqDevice, [{'key': 'targetStatus', 'value': self.pluginHandles.circuit(masqDevice.pluginProps["devicePlugin"])}], None)
+            self.flushWrites()
+
+    def reconcileDevices(self):
+        # first sync of the devices started since the last pass, each base device is fetched once
+        startTime = time.time()
+        writesIssued = self.counters["writesIssued"]
+        baseDevices = {}
+        with self.updateLock:
+            masqIds, self.reconcilePending = self.reconcilePending, set()
+            if not masqIds:
+                return
+            for masqDeviceId in sorted(masqIds):
+                self.syncMasqDevice(self.masqueradeList[masqDeviceId], baseDevices)
+        self.logger.info(u"Reconciled %d masquerade devices with %d base devices in %.1f ms, %d writes" %
+                         (len(masqIds), len(baseDevices), (time.time() - startTime) * 1000.0, self.counters["writesIssued"] - writesIssued))
+
+    def compileMasqPlan(self, masqDevice):
+        self.timingKeys[masqDevice.id] = u"updateDevice %s/%s" % (masqDevice.deviceTypeId, masqDevice.pluginProps.get("masqSensorSubtype", u"-"))
+        try:
+            self.masqPlans[masqDevice.id] = compilePlan(masqDevice.deviceTypeId, masqDevice.pluginProps)
+            timeout = staleTimeout(masqDevice.pluginProps)
+        except (KeyError, ValueError) as err:
+            self.logger.error(u"Unable to compile settings for %s: %s" % (masqDevice.name, err))
+            self.masqPlans.pop(masqDevice.id, None)
+            timeout = 0.0
+        self.watchDevice(masqDevice, timeout)
 
 
     ########################################
     # Menu Methods
     ########################################
 
+    def perfSnapshot(self):
+        with self.updateLock:
+            counters = dict(self.counters)
+            devices = {"masquerades": len(self.masqueradeList), "baseDevices": len(self.baseIndex),
+                       "pendingConfirms": len(self.expectations), "staleDevices": len(self.staleDevices), "timers": len(self.timers)}
+        return {
+            "time":         time.strftime("%Y-%m-%d %H:%M:%S"),
+            "seconds":      time.time() - self.statsSince,
+            "counters":     counters,
+            "timings":      self.timings.snapshot(),
+            "dispatch":     self.dispatcher.stats(),
+            "devices":      devices,
+        }
+
+    def showPerfStats(self):
+        stats = self.perfSnapshot()
+        counters = stats["counters"]
+        indigo.server.log(u"Masquerade performance stats for the last %.0f seconds:" % stats["seconds"])
+        indigo.server.log(u"  %(masquerades)d masquerade devices following %(baseDevices)d base devices, %(timers)d timers" % stats["devices"])
+        indigo.server.log(u"  deviceUpdated events: %d, for masqueraded devices: %d" %
+                          (counters.get("deviceUpdatedSeen", 0), counters.get("deviceUpdatedMatched", 0)))
+        indigo.server.log(u"  state writes issued: %d, suppressed as unchanged: %d, filtered by deadband: %d" %
+                          (counters.get("writesIssued", 0), counters.get("writesSuppressed", 0), counters.get("deadbandFiltered", 0)))
+        indigo.server.log(u"  actions submitted: %(submitted)d, dispatched: %(dispatched)d, coalesced: %(coalesced)d, failed: %(failed)d, "
+                          u"queued: %(queueDepth)d, queue wait avg %(latencyAvgMs).1f ms, max %(latencyMaxMs).1f ms" % stats["dispatch"])
+        for name, timing in sorted(stats["timings"].iteritems()):
+            indigo.server.log(u"  %-45s %8d calls, avg %8.3f ms, max %8.3f ms" % (name, timing["count"], timing["avgMs"], timing["maxMs"]))
+
+    def resetPerfStats(self):
+        with self.updateLock:
+            self.counters.clear()
+        self.timings.reset()
+        self.dispatcher.resetStats()
+        self.statsSince = time.time()
+        indigo.server.log(u"Masquerade performance stats reset")
+
+
+    def startEventTrace(self):
+        if self.trace is not None:
+            indigo.server.log(u"Event trace is already running, saving to %s" % self.trace.path)
+            return
+        path = os.path.expanduser(self.pluginPrefs.get("tracePath", u"") or u"~/Documents/Masquerade Trace.jsonl")
+        try:
+            trace = TraceRecorder(path)
+        except (IOError, OSError) as err:
+            self.logger.error(u"Unable to start the event trace in %s: %s" % (path, err))
+            return
+        with self.updateLock:
+            for masqDevice in self.masqueradeList.values():
+                trace.recordMasq(masqDevice)
+                for baseDeviceId in self.indexedBases.get(masqDevice.id, ()):
+                    try:
+                        trace.recordBase(indigo.devices[baseDeviceId])
+                    except KeyError:
+                        pass
+            self.trace = trace
+        indigo.server.log(u"Event trace started, saving to %s" % path)
+
+    def traceMasqDevice(self, masqDevice):
+        self.trace.recordMasq(masqDevice)
+        try:
+            for baseDeviceId in baseDeviceIds(masqDevice.deviceTypeId, masqDevice.pluginProps):
+                self.trace.recordBase(indigo.devices[baseDeviceId])
+        except (KeyError, ValueError):
+            pass
+
+    def stopEventTrace(self):
+        trace, self.trace = self.trace, None
+        if trace is None:
+            indigo.server.log(u"No event trace is running")
+            return
+        trace.close()
+        indigo.server.log(u"Event trace stopped, %d records saved to %s" % (trace.records, trace.path))
+
+
+    ########################################
+    # Plugin Actions
+    ########################################
+
+    def dumpPerfStats(self, pluginAction):
+        path = os.path.expanduser(pluginAction.props.get("filePath", u"") or u"~/Documents/Masquerade Stats.json")
+        try:
+            with open(path, "w") as statsFile:
+                json.dump(self.perfSnapshot(), statsFile, indent=2, sort_keys=True)
+        except (IOError, OSError) as err:
+            self.logger.error(u"Unable to save performance stats to %s: %s" % (path, err))
+            return
+        self.logger.info(u"Saved performance stats to %s" % path)
+
 
 
     ########################################
@@ -93,245 +1737,479 @@ class Plugin(indigo.PluginBase):
     def closedPrefsConfigUi(self, valuesDict, userCancelled):
         if not userCancelled:
             try:
-                self.logLevel = int(valuesDict[u"logLevel"])
+                self.setLogLevel(int(valuesDict[u"logLevel"]))
             except:
-                self.logLevel = logging.INFO
-            self.indigo_log_handler.setLevel(self.logLevel)
+                self.setLogLevel(logging.INFO)
             self.logger.debug(u"logLevel = " + str(self.logLevel))
 
     ################################################################################
     #
-    #   Scaling methods
+    # delegate methods for indigo.devices.subscribeToChanges()
+    #
+    ################################################################################
 
-    def scaleBaseToMasq(self, masqDevice, input):
+    def deviceCreated(self, newDevice):
+        indigo.PluginBase.deviceCreated(self, newDevice)
 
-        lowLimit = int(masqDevice.pluginProps["lowLimitState"])
-        highLimit = int(masqDevice.pluginProps["highLimitState"])
-        reverse = bool(masqDevice.pluginProps["reverseState"])
+        if self.deviceIndex.loaded:
+            self.deviceIndex.add(newDevice)
 
-        if input < lowLimit:
-            self.logger.warning(u"scaleBaseToMasq: Input value for %s is lower than expected: %d" % (masqDevice.name, input))
-            input = lowLimit
-        elif input > highLimit:
-            self.logger.warning(u"scaleBaseToMasq: Input value for %s is higher than expected: %d" % (masqDevice.name, input))
-            input = highLimit
 
-        scaled = int((input - lowLimit) * (100.0 / (highLimit - lowLimit)))
+    def deviceDeleted(self, delDevice):
+        indigo.PluginBase.deviceDeleted(self, delDevice)
 
-        if reverse:
-            scaled = 100 - scaled
+        self.deviceIndex.remove(delDevice.id)
+
+        for myDeviceId in sorted(self.baseIndex.get(delDevice.id, ())):
+            myDevice = self.masqueradeList[myDeviceId]
+            plan = self.masqPlans.get(myDeviceId)
+            if isinstance(plan, AggregatePlan):
+                self.logger.info(u"A device (%s) that was being Masqueraded has been deleted.  Removing it from %s" % (delDevice.name, myDevice.name))
+                with self.updateLock:
+                    update = plan.removeBase(delDevice.id)
+                    if update is not None:
+                        self.queueWrite(myDevice, *update)
+                    self.flushWrites()
+            else:
+                self.logger.info(u"A device (%s) that was being Masqueraded has been deleted.  Disabling %s" % (delDevice.name, myDevice.name))
+                indigo.device.enable(myDevice, value=False)   #disable it
 
-        self.logger.debug(u"scaleBaseToMasq: lowLimit = %d, highLimit = %d, reverse = %s, input = %d, scaled = %d" % (lowLimit, highLimit, str(reverse), input, scaled))
-        return scaled
 
-    def scaleMasqToBase(self, masqDevice, input):
+    def deviceUpdated(self, oldDevice, newDevice):
+        indigo.PluginBase.deviceUpdated(self, oldDevice, newDevice)
 
-        lowLimit = int(masqDevice.pluginProps["lowLimitAction"])
-        highLimit = int(masqDevice.pluginProps["highLimitAction"])
-        reverse = bool(masqDevice.pluginProps["reverseAction"])
-        valFormat = masqDevice.pluginProps["masqValueFormat"]
+        self.counters["deviceUpdatedSeen"] += 1
+        self.deviceIndex.update(oldDevice, newDevice)
 
-        scaled = int((input * (highLimit - lowLimit) / 100.0) + lowLimit)
+        if newDevice.id in self.masqueradeList:
+            self.refreshMasqDevice(newDevice)
 
-        if reverse:
-            scaled = highLimit - (scaled - lowLimit)
-
-        if valFormat == "Decimal":
-            scaledString = str(scaled)
-        elif valFormat == "Hexidecimal":
-            scaledString = '{:02x}'.format(scaled)
-        elif valFormat == "Octal":
-            scaledString = oct(scaled)
-        else:
-            self.logger.error(u"scaleBaseToMasq: Unknown masqValueFormat = %s" % (valFormat))
+        masqIds = self.baseIndex.get(newDevice.id)
+        if not masqIds:
+            return
 
-        self.logger.debug(u"scaleMasqToBase: lowLimit = %d, highLimit = %d, reverse = %s, input = %d, format = %s, scaled = %s" % (lowLimit, highLimit, str(reverse), input, valFormat, scaledString))
-        return scaledString
+        self.counters["deviceUpdatedMatched"] += 1
+        if self.trace is not None:
+            self.trace.recordUpdate(oldDevice, newDevice)
+        now = time.time()
+        with self.updateLock:
+            for masqDeviceId in sorted(masqIds):
+                if masqDeviceId in self.staleTimeouts:
+                    self.baseSeen(masqDeviceId, now)
+                if masqDeviceId in self.reconcilePending:
+                    continue            # gets a full sync from reconcileDevices()
+                self.updateDevice(self.masqueradeList[masqDeviceId], oldDevice, newDevice)
+            self.flushWrites()
 
 
-    ################################################################################
-    #
-    # delegate methods for indigo.devices.subscribeToChanges()
-    #
-    ################################################################################
+    def updateDevice(self, masqDevice, oldDevice, newDevice):
+        plan = self.masqPlans.get(masqDevice.id)
+        if plan is None:
+            return
 
-    def deviceDeleted(self, delDevice):
-        indigo.PluginBase.deviceDeleted(self, delDevice)
+        startTime = time.time()
+        try:
+            self.applyPlan(plan, masqDevice, oldDevice, newDevice)
+        finally:
+            self.timings.add(self.timingKeys[masqDevice.id], time.time() - startTime)
 
-        for myDeviceId, myDevice in sorted(self.masqueradeList.iteritems()):
-            baseDevice = int(myDevice.pluginProps["baseDevice"])
-            if delDevice.id == baseDevice:
-                self.logger.info(u"A device (%s) that was being Masqueraded has been deleted.  Disabling %s" % (delDevice.name, myDevice.name))
-                indigo.device.enable(myDevice, value=False)   #disable it
+    def applyPlan(self, plan, masqDevice, oldDevice, newDevice):
+        update = plan.apply(masqDevice.id, oldDevice, newDevice)
+        if update is None:
+            return
 
+        stateList, stateImage = update
+        self.logger.debug(u"updateDevice %s: %s --> %s %s", masqDevice.deviceTypeId, newDevice.name, masqDevice.name, stateList)
+        if masqDevice.id in self.expectations and oldDevice is not None:
+            self.absorbEcho(masqDevice, stateList)
+        elif plan.throttled and oldDevice is not None:
+            self.throttleUpdate(masqDevice, plan, stateList, stateImage)
+        else:
+            self.publishUpdate(masqDevice, stateList, stateImage)
 
-    def deviceUpdated(self, oldDevice, newDevice):
-        indigo.PluginBase.deviceUpdated(self, oldDevice, newDevice)
 
-        for masqDeviceId, masqDevice in sorted(self.masqueradeList.iteritems()):
-            baseDevice = int(masqDevice.pluginProps["baseDevice"])
-            if oldDevice.id == baseDevice:
-                self.updateDevice(masqDevice, oldDevice, newDevice)
+    ########################################
+    # Throttling for noisy sources
+    #
+    # masqValueSensor: changes within the deadband of the last published value are
+    # dropped, and publishes closer together than minInterval are held until the
+    # interval has passed, keeping only the latest value (trailing edge).
+    # masqSensor: a new match result has to hold for onDelay / offDelay seconds
+    # before it is published.
+    ########################################
 
+    def publishUpdate(self, masqDevice, stateList, stateImage):
+        throttle = self.throttles.get(masqDevice.id)
+        if throttle is not None:
+            throttle.lastValue = stateList[0]['value']
+            throttle.lastTime = time.time()
+            throttle.pending = None
+            self.timers.cancel(("throttle", masqDevice.id))
+        self.queueWrite(masqDevice, stateList, stateImage)
+
+    def throttleUpdate(self, masqDevice, plan, stateList, stateImage):
+        throttle = self.throttles.get(masqDevice.id)
+        if throttle is None:
+            throttle = self.throttles[masqDevice.id] = ThrottleState()
+            lastValue = self.lastWritten.get(masqDevice.id, {}).get(stateList[0]['key'])
+            if lastValue is not None:
+                throttle.lastValue = lastValue[0]
+
+        value = stateList[0]['value']
+        now = time.time()
+        timerKey = ("throttle", masqDevice.id)
+
+        if throttle.lastValue is None:
+            self.publishUpdate(masqDevice, stateList, stateImage)
+            return
 
-    def updateDevice(self, masqDevice, oldDevice, newDevice):
         if masqDevice.deviceTypeId == "masqSensor":
-            masqState = masqDevice.pluginProps["masqState"]
-            if oldDevice == None or oldDevice.states[masqState] != newDevice.states[masqState]:
-                matchString = masqDevice.pluginProps["matchString"]
-                reverse = bool(masqDevice.pluginProps["reverse"])
-                match = (str(newDevice.states[masqState]) == matchString)
-                if reverse:
-                    match = not match
-                self.logger.debug(u"updateDevice masqSensor:  %s (%s) --> %s (%s)" % (newDevice.name, newDevice.states[masqState], masqDevice.name, str(match)))
-
-                if masqDevice.pluginProps["masqSensorSubtype"] == "Generic":
-                    masqDevice.updateStateOnServer(key='onOffState', value = match)
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.None)
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "MotionSensor":
-                    masqDevice.updateStateOnServer(key='onOffState', value = match)
-                    if match:
-                        masqDevice.updateStateImageOnServer(indigo.kStateImageSel.MotionSensorTripped)
-                    else:
-                        masqDevice.updateStateImageOnServer(indigo.kStateImageSel.MotionSensor)
-                    
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "Power":
-                    masqDevice.updateStateOnServer(key='onOffState', value = match)
-                    if match:
-                        masqDevice.updateStateImageOnServer(indigo.kStateImageSel.PowerOn)
-                    else:
-                        masqDevice.updateStateImageOnServer(indigo.kStateImageSel.PowerOff)
-                    
-                else:
-                    self.logger.debug(u"updateDevice masqSensor, unknown subtype: %s" % (masqDevice.pluginProps["masqSensorSubtype"]))
-
-        elif masqDevice.deviceTypeId == "masqValueSensor":
-            masqState = masqDevice.pluginProps["masqState"]
-            if oldDevice == None or oldDevice.states[masqState] != newDevice.states[masqState]:
-                baseValue = float(newDevice.states[masqState])
-                self.logger.debug(u"updateDevice masqValueSensor: %s (%d) --> %s (%d)" % (newDevice.name, baseValue, masqDevice.name, baseValue))
-                
-                if masqDevice.pluginProps["masqSensorSubtype"] == "Generic":
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.None)
-                    masqDevice.updateStateOnServer(key='sensorValue', value = baseValue)
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "Temperature-F":
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.TemperatureSensor)
-                    masqDevice.updateStateOnServer(key='sensorValue', value = baseValue, decimalPlaces=1, uiValue=str(baseValue) + u' °F')
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "Temperature-C":
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.TemperatureSensor)
-                    masqDevice.updateStateOnServer(key='sensorValue', value = baseValue, decimalPlaces=1, uiValue=str(baseValue) + u' °C')
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "Humidity":
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.HumiditySensor)
-                    masqDevice.updateStateOnServer(key='sensorValue', value = baseValue, decimalPlaces=0, uiValue=str(baseValue) + u'%')
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "Luminence":
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.LightSensor)
-                    masqDevice.updateStateOnServer(key='sensorValue', value = baseValue, decimalPlaces=0, uiValue=str(baseValue) + u' lux')
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "Luminence%":
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.LightSensor)
-                    masqDevice.updateStateOnServer(key='sensorValue', value = baseValue, decimalPlaces=0, uiValue=str(baseValue) + u'%')
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "Energy":
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.EnergyMeterOn)
-                    masqDevice.updateStateOnServer(key='sensorValue', value = baseValue, decimalPlaces=0, uiValue=str(baseValue) + u' watts')
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "ppm":
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.None)
-                    masqDevice.updateStateOnServer(key='sensorValue', value = baseValue, decimalPlaces=0, uiValue=str(baseValue) + u'ppm')
+            if value == throttle.lastValue:
+                # flipped back before the delay expired
+                throttle.pending = None
+                self.timers.cancel(timerKey)
+                return
+            delay = plan.onDelay if value else plan.offDelay
+            if delay <= 0:
+                self.publishUpdate(masqDevice, stateList, stateImage)
+            elif throttle.pending is None:
+                throttle.pending = (masqDevice, stateList, stateImage)
+                self.timers.schedule(timerKey, now + delay, lambda: self.publishPending(masqDevice.id))
+            return
+
+        if plan.inDeadband(value, throttle.lastValue):
+            self.counters["deadbandFiltered"] += 1
+            throttle.pending = None
+            self.timers.cancel(timerKey)
+            return
+
+        due = throttle.lastTime + plan.minInterval
+        if now >= due:
+            self.publishUpdate(masqDevice, stateList, stateImage)
+            return
+
+        if throttle.pending is None:
+            self.timers.schedule(timerKey, due, lambda: self.publishPending(masqDevice.id))
+        throttle.pending = (masqDevice, stateList, stateImage)
+
+    def publishPending(self, masqDeviceId):
+        with self.updateLock:
+            throttle = self.throttles.get(masqDeviceId)
+            if throttle is None or throttle.pending is None:
+                return
+            self.publishUpdate(*throttle.pending)
+            self.flushWrites()
+
+
+    ########################################
+    # Staleness watchdog
+    #
+    # A watched masquerade has one ("stale", id) timer, due staleTimeout after it was
+    # armed.  Base updates only record the time in lastSeen, so a busy device costs a
+    # dict write per update.  When the timer fires it re-arms itself for lastSeen +
+    # staleTimeout if there was an update since, otherwise the device is marked stale
+    # until its next base update.  A state update clears a device's error state, so
+    # flushWrites sets it again after writing to a stale device.
+    ########################################
+
+    def watchDevice(self, masqDevice, timeout):
+        with self.updateLock:
+            if timeout > 0:
+                self.staleTimeouts[masqDevice.id] = timeout
+                self.lastSeen[masqDevice.id] = time.time()
+                self.armStaleTimer(masqDevice.id, time.time() + timeout)
+            elif self.staleTimeouts.pop(masqDevice.id, None) is not None:
+                self.lastSeen.pop(masqDevice.id, None)
+                self.timers.cancel(("stale", masqDevice.id))
+                if masqDevice.id in self.staleDevices:
+                    self.staleDevices.discard(masqDevice.id)
+                    masqDevice.setErrorStateOnServer(None)
+
+    def armStaleTimer(self, masqDeviceId, due):
+        self.timers.schedule(("stale", masqDeviceId), due, lambda: self.checkStale(masqDeviceId))
+
+    def baseSeen(self, masqDeviceId, now):
+        self.lastSeen[masqDeviceId] = now
+        if masqDeviceId not in self.staleDevices:
+            return
+        self.staleDevices.discard(masqDeviceId)
+        masqDevice = self.masqueradeList[masqDeviceId]
+        masqDevice.setErrorStateOnServer(None)
+        self.armStaleTimer(masqDeviceId, now + self.staleTimeouts[masqDeviceId])
+        self.logger.info(u"%s: masqueraded device is reporting again", masqDevice.name)
+
+    def checkStale(self, masqDeviceId):
+        with self.updateLock:
+            timeout = self.staleTimeouts.get(masqDeviceId)
+            if timeout is None:
+                return
+            due = self.lastSeen[masqDeviceId] + timeout
+            if time.time() < due:
+                self.armStaleTimer(masqDeviceId, due)
+                return
+            masqDevice = self.masqueradeList[masqDeviceId]
+            self.staleDevices.add(masqDeviceId)
+            self.counters["staleMarked"] += 1
+            masqDevice.setErrorStateOnServer(kStaleError)
+        self.logger.warning(u"%s: no update from the masqueraded device for %g minutes", masqDevice.name, timeout / 60)
 
-                else:
-                    self.logger.debug(u"updateDevice masqSensor, unknown subtype: %s" % (masqDevice.pluginProps["masqSensorSubtype"]))
-                    
 
-        elif masqDevice.deviceTypeId == "masqDimmer":
-            masqState = masqDevice.pluginProps["masqState"]
-            if oldDevice == None or oldDevice.states[masqState] != newDevice.states[masqState]:
-                baseValue = int(newDevice.states[masqState])
-                scaledValue = self.scaleBaseToMasq(masqDevice, baseValue)
-                self.logger.debug(u"updateDevice masqDimmer: %s (%d) --> %s (%d)" % (newDevice.name, baseValue, masqDevice.name, scaledValue))
-                masqDevice.updateStateOnServer(key='brightnessLevel', value = scaledValue)
+    ########################################
+    # Optimistic updates
+    #
+    # With optimisticUpdates set, a masqDimmer that sends a plugin action shows the
+    # brightness the base device will report as soon as the action arrives: the value
+    # sent, mapped back through the state scaling.  Base device changes that match it
+    # are absorbed, others are held until the base confirms or confirmTimeout passes,
+    # when the masquerade is re-synced with whatever the base device actually reports.
+    # Standard Indigo commands only turn the base device on or off, its brightness
+    # afterwards isn't known, so those dimmers aren't optimistic.
+    ########################################
+
+    def expectBrightness(self, action, dev):
+        plan = self.masqPlans.get(dev.id)
+        if not isinstance(plan, DimmerPlan) or not plan.optimistic:
+            return
+        if not self.usesPluginAction(dev) or not dev.pluginProps.get("masqValueField"):
+            return
+        # the base value dispatchControlDevice will send
+        if action.deviceAction == indigo.kDeviceAction.TurnOn:
+            baseValue = dev.pluginProps["highLimitState"]
+        elif action.deviceAction == indigo.kDeviceAction.TurnOff:
+            baseValue = dev.pluginProps["lowLimitState"]
+        elif action.deviceAction == indigo.kDeviceAction.SetBrightness:
+            baseValue = plan.actionTransform.inverse[min(100, max(0, int(action.actionValue)))]
+        else:
+            return
+        brightness = plan.echoBrightness(baseValue)
+
+        with self.updateLock:
+            masqDevice = self.masqueradeList.get(dev.id)
+            if masqDevice is None:
+                return
+            self.expectations[dev.id] = brightness
+            self.timers.schedule(("confirm", dev.id), time.time() + plan.confirmTimeout, lambda: self.confirmExpired(dev.id))
+            self.queueWrite(masqDevice, [{'key': 'brightnessLevel', 'value': brightness}], None)
+            self.flushWrites()
+
+    def absorbEcho(self, masqDevice, stateList):
+        if stateList[0]['value'] == self.expectations[masqDevice.id]:
+            del self.expectations[masqDevice.id]
+            self.timers.cancel(("confirm", masqDevice.id))
+            self.counters["echoesAbsorbed"] += 1
+        else:
+            self.counters["echoesHeld"] += 1
+
+    def confirmExpired(self, masqDeviceId):
+        with self.updateLock:
+            expected = self.expectations.pop(masqDeviceId, None)
+            masqDevice = self.masqueradeList.get(masqDeviceId)
+            if expected is None or masqDevice is None:
+                return
+            self.syncMasqDevice(masqDevice)
+            actual = self.lastWritten.get(masqDeviceId, {}).get('brightnessLevel', (None, None))[0]
+        if actual != expected:
+            self.counters["optimisticRollbacks"] += 1
+            limitedLog.warning((masqDeviceId, "confirm"), u"%s: base device did not confirm brightness %d, now %s", masqDevice.name, expected, actual)
 
-        elif masqDevice.deviceTypeId == "masqSpeedControl":
-            if oldDevice == None or oldDevice.brightness != newDevice.brightness:
-                baseValue = newDevice.brightness    # convert this to a speedIndex?
-                self.logger.debug(u"updateDevice masqSpeedControl: %s (%d) --> %s (%d)" % (newDevice.name, baseValue, masqDevice.name, baseValue))
-                masqDevice.updateStateOnServer(key='speedLevel', value = baseValue)
 
-        elif masqDevice.deviceTypeId == "masqSprinkler":
-            if oldDevice == None or oldDevice.onState != newDevice.onState:
-                self.logger.debug(u"updateDevice masqSprinkler: {} ({}) --> {} ({})".format(newDevice.name, newDevice.onState, masqDevice.name, newDevice.onState))
-                masqDevice.updateStateOnServer(key='activeZone', value = (1 if newDevice.onState else 0))
+    ########################################
+    # Batched state writes
+    #
+    # Updates are queued per masquerade device while a base device event is processed,
+    # then flushed with one updateStatesOnServer call per device.  States and images
+    # that match what the masquerade device already shows are not sent at all.
+    ########################################
+
+    def seedWriteCache(self, masqDevice):
+        # start from what the device is showing now, so a restart doesn't rewrite unchanged states
+        self.lastWritten[masqDevice.id] = dict((key, (value, masqDevice.states.get(key + u".ui")))
+                                               for key, value in masqDevice.states.iteritems() if not key.endswith(u".ui"))
+        stateImage = getattr(masqDevice, "displayStateImageSel", None)
+        if stateImage is not None:
+            self.stateImages[masqDevice.id] = stateImage
+
+    def queueWrite(self, masqDevice, stateList, stateImage):
+        pending = self.pendingWrites.get(masqDevice.id)
+        if pending is None:
+            self.pendingWrites[masqDevice.id] = (masqDevice, list(stateList), stateImage)
+            return
 
+        pendingStates, pendingImage = pending[1:]
+        newKeys = set(state['key'] for state in stateList)
+        pendingStates = [state for state in pendingStates if state['key'] not in newKeys] + list(stateList)
+        self.pendingWrites[masqDevice.id] = (masqDevice, pendingStates, stateImage if stateImage is not None else pendingImage)
+
+    def flushWrites(self):
+        pendingWrites, self.pendingWrites = self.pendingWrites, {}
+        for masqDeviceId, (masqDevice, stateList, stateImage) in sorted(pendingWrites.iteritems()):
+            lastWritten = self.lastWritten.setdefault(masqDeviceId, {})
+            changedStates = []
+            for state in stateList:
+                lastValue, lastUiValue = lastWritten.get(state['key'], (None, None))
+                if lastValue != state['value'] or lastUiValue != state.get('uiValue', lastUiValue) or state['key'] not in lastWritten:
+                    changedStates.append(state)
+
+            imageChanged = stateImage is not None and self.stateImages.get(masqDeviceId) != stateImage
+            if not changedStates and not imageChanged:
+                self.counters["writesSuppressed"] += 1
+                continue
+
+            if imageChanged:
+                masqDevice.updateStateImageOnServer(stateImage)
+                self.stateImages[masqDeviceId] = stateImage
+                self.counters["writesIssued"] += 1
+            if changedStates:
+                masqDevice.updateStatesOnServer(changedStates)
+                for state in changedStates:
+                    lastWritten[state['key']] = (state['value'], state.get('uiValue'))
+                self.counters["writesIssued"] += 1
+            if masqDeviceId in self.staleDevices:
+                masqDevice.setErrorStateOnServer(kStaleError)   # the write cleared it
 
 
+    ########################################
+    # Action callbacks queue the command for the dispatcher, keyed by base device
     ########################################
 
     def actionControlDevice(self, action, dev):
+        if self.trace is not None:
+            self.trace.recordAction("device", action, dev, action.deviceAction)
+        self.expectBrightness(action, dev)
+        coalesce = "brightness" if action.deviceAction == indigo.kDeviceAction.SetBrightness else None
+        group = dev.pluginProps["devicePlugin"] if self.usesPluginAction(dev) else None     # limits the calls in flight per target plugin
+        self.dispatcher.submit(int(dev.pluginProps["baseDevice"]), lambda: self.dispatchTimed(self.dispatchControlDevice, action, dev), coalesce, group)
+
+    def actionControlSpeedControl(self, action, dev):
+        if self.trace is not None:
+            self.trace.recordAction("speed", action, dev, action.speedControlAction)
+        self.dispatcher.submit(int(dev.pluginProps["baseDevice"]), lambda: self.dispatchTimed(self.dispatchControlSpeedControl, action, dev), "speed")
 
-        if dev.pluginProps['masqAction']=="use Standard Indigo Commands":
+    def actionControlSprinkler(self, action, dev):
+        if self.trace is not None:
+            self.trace.recordAction("sprinkler", action, dev, action.sprinklerAction)
+        self.dispatcher.submit(int(dev.pluginProps["baseDevice"]), lambda: self.dispatchTimed(self.dispatchControlSprinkler, action, dev))
+
+    def dispatchTimed(self, function, action, dev):
+        # time each command by the plugin it goes to, standard Indigo commands count as "indigo"
+        target = dev.pluginProps["devicePlugin"] if self.usesPluginAction(dev) else u"indigo"
+        startTime = time.time()
+        try:
+            function(action, dev)
+        finally:
+            self.timings.add(u"dispatch " + target, time.time() - startTime)
+
+
+    def dispatchControlDevice(self, action, dev):
+
+        if not self.usesPluginAction(dev):
             if action.deviceAction == indigo.kDeviceAction.TurnOn:
-                self.logger.debug(u"actionControlDevice: \"%s\" Turn On" % dev.name)
+                self.logger.debug(u"actionControlDevice: \"%s\" Turn On", dev.name)
                 indigo.device.turnOn(int(dev.pluginProps["baseDevice"]))
             elif action.deviceAction == indigo.kDeviceAction.TurnOff:
-                self.logger.debug(u"actionControlDevice: \"%s\" Turn Off" % dev.name)
+                self.logger.debug(u"actionControlDevice: \"%s\" Turn Off", dev.name)
                 indigo.device.turnOff(int(dev.pluginProps["baseDevice"]))
             elif action.deviceAction == indigo.kDeviceAction.SetBrightness:
-                self.logger.debug(u"actionControlDevice: \"%s\" Set Brightness to %d " % (dev.name, action.actionValue))
+                self.logger.debug(u"actionControlDevice: \"%s\" Set Brightness to %d", dev.name, action.actionValue)
                 if action.actionValue >0:
                     indigo.device.turnOn(int(dev.pluginProps["baseDevice"]))
                 elif action.actionValue == 0:
                     indigo.device.turnOff(int(dev.pluginProps["baseDevice"]))
             return
         else:
-            basePlugin = indigo.server.getPlugin(dev.pluginProps["devicePlugin"])
-            if basePlugin.isEnabled():
-                if action.deviceAction == indigo.kDeviceAction.TurnOn:
-                    self.logger.debug(u"actionControlDevice: \"%s\" Turn On" % dev.name)
-                    if dev.pluginProps["masqValueField"]:
-                        props = { dev.pluginProps["masqValueField"] : dev.pluginProps["highLimitState"] }
-                        basePlugin.executeAction(dev.pluginProps["masqAction"], deviceId=int(dev.pluginProps["baseDevice"]),  props=props)
-                    else:
-                        basePlugin.executeAction(dev.pluginProps["masqAction"], deviceId=int(dev.pluginProps["baseDevice"]) )
-
-                elif action.deviceAction == indigo.kDeviceAction.TurnOff:
-                    self.logger.debug(u"actionControlDevice: \"%s\" Turn Off" % dev.name)
-                    if dev.pluginProps["masqValueField"]:
-                        props = { dev.pluginProps["masqValueField"]: dev.pluginProps["lowLimitState"] }
-                        basePlugin.executeAction(dev.pluginProps["masqAction"], deviceId=int(dev.pluginProps["baseDevice"]),  props=props)
-                    else:
-                        basePlugin.executeAction(dev.pluginProps["masqAction"], deviceId=int(dev.pluginProps["baseDevice"]))
-
-                elif action.deviceAction == indigo.kDeviceAction.SetBrightness:
-                    if dev.pluginProps["masqValueField"]:
-                        scaledValueString = self.scaleMasqToBase(dev, action.actionValue)
-                        self.logger.debug(u"actionControlDevice: \"%s\" Set Brightness to %d (scaled = %s)" % (dev.name, action.actionValue, scaledValueString))
-                        props = { dev.pluginProps["masqValueField"] : scaledValueString }
-                        basePlugin.executeAction(dev.pluginProps["masqAction"], deviceId=int(dev.pluginProps["baseDevice"]),  props=props)
+            if action.deviceAction == indigo.kDeviceAction.TurnOn:
+                self.logger.debug(u"actionControlDevice: \"%s\" Turn On", dev.name)
+                if dev.pluginProps["masqValueField"]:
+                    props = { dev.pluginProps["masqValueField"] : dev.pluginProps["highLimitState"] }
+                else:
+                    props = None
 
+            elif action.deviceAction == indigo.kDeviceAction.TurnOff:
+                self.logger.debug(u"actionControlDevice: \"%s\" Turn Off", dev.name)
+                if dev.pluginProps["masqValueField"]:
+                    props = { dev.pluginProps["masqValueField"]: dev.pluginProps["lowLimitState"] }
                 else:
-                    self.logger.error(u"actionControlDevice: \"%s\" Unsupported action requested: %s" % (dev.name, str(action)))
+                    props = None
+
+            elif action.deviceAction == indigo.kDeviceAction.SetBrightness:
+                if not dev.pluginProps["masqValueField"]:
+                    return
+                scaledValueString = self.masqPlans[dev.id].scaleMasqToBase(action.actionValue)
+                self.logger.debug(u"actionControlDevice: \"%s\" Set Brightness to %d (scaled = %s)", dev.name, action.actionValue, scaledValueString)
+                props = { dev.pluginProps["masqValueField"] : scaledValueString }
 
             else:
-                self.logger.warning(u"actionControlDevice: Device %s is disabled." % (dev.name))
+                self.logger.error(u"actionControlDevice: \"%s\" Unsupported action requested: %s", dev.name, action)
+                return
 
+            self.executePluginAction(dev, props)
 
-    def actionControlSpeedControl(self, action, dev):
-        self.logger.debug(u"actionControlSpeedControl: \"%s\" Set Speed to %d" % (dev.name, action.actionValue))
-        scaleFactor = int(dev.pluginProps["scaleFactor"])
-        indigo.dimmer.setBrightness(int(dev.pluginProps["baseDevice"]), value=(action.actionValue * scaleFactor))
 
+    def usesPluginAction(self, dev):
+        return dev.deviceTypeId == "masqDimmer" and dev.pluginProps.get('masqAction', "use Standard Indigo Commands") != "use Standard Indigo Commands"
 
-    def actionControlSprinkler(self, action, dev):
+    def executePluginAction(self, dev, props):
+        bundleId = dev.pluginProps["devicePlugin"]
+        token = self.pluginHandles.allow(bundleId)
+        if token is None:
+            self.logger.debug(u"actionControlDevice: \"%s\" not sent, %s is not responding", dev.name, bundleId)
+            return
+
+        startTime = time.time()
+        timerKey = ("callTimeout", token)
+        self.timers.schedule(timerKey, startTime + kActionTimeout, lambda: self.pluginCallOverdue(bundleId))
+        succeeded = False
+        try:
+            basePlugin = self.pluginHandles.getPlugin(bundleId)
+            if not basePlugin.isEnabled():
+                limitedLog.warning((dev.id, "disabled"), u"actionControlDevice: Device %s is disabled.", dev.name)
+                return
+            if props:
+                basePlugin.executeAction(dev.pluginProps["masqAction"], deviceId=int(dev.pluginProps["baseDevice"]),  props=props)
+            else:
+                basePlugin.executeAction(dev.pluginProps["masqAction"], deviceId=int(dev.pluginProps["baseDevice"]))
+            elapsed = time.time() - startTime
+            if elapsed > kActionTimeout:
+                limitedLog.warning((dev.id, "slowAction"), u"actionControlDevice: \"%s\" executeAction took %.1f seconds", dev.name, elapsed)
+            else:
+                succeeded = True
+        except Exception as err:
+            self.logger.error(u"actionControlDevice: \"%s\" executeAction failed: %s", dev.name, err)
+        finally:
+            self.timers.cancel(timerKey)
+            self.pluginHandles.finish(bundleId, token, succeeded)
+
+    def pluginCallOverdue(self, bundleId):
+        # a call has been out for kActionTimeout: count it, and let the commands parked
+        # behind it run so they are dropped now rather than when it returns
+        if self.pluginHandles.checkHung(bundleId):
+            self.dispatcher.release(bundleId)
+
+    def circuitChanged(self, bundleId, circuit):
+        if circuit == kCircuitOpen:
+            self.logger.warning(u"Plugin %s is not responding, dropping commands for %d seconds" % (bundleId, kBreakerCooldown))
+        elif circuit == kCircuitClosed:
+            self.logger.info(u"Plugin %s is responding again" % (bundleId))
+
+        with self.updateLock:
+            for masqDevice in self.masqueradeList.values():
+                if self.usesPluginAction(masqDevice) and masqDevice.pluginProps["devicePlugin"] == bundleId:
+                    self.queueWrite(masqDevice, [{'key': 'targetStatus', 'value': circuit}], None)
+            self.flushWrites()
+
+
+    def dispatchControlSpeedControl(self, action, dev):
+        self.logger.debug(u"actionControlSpeedControl: \"%s\" Set Speed to %d", dev.name, action.actionValue)
+        brightness = self.masqPlans[dev.id].baseBrightness(action.actionValue)
+        indigo.dimmer.setBrightness(int(dev.pluginProps["baseDevice"]), value=brightness)
+
+
+    def dispatchControlSprinkler(self, action, dev):
         if action.sprinklerAction == indigo.kSprinklerAction.ZoneOn:
-            self.logger.debug(u"actionControlSprinkler: \"{}\" On".format(dev.name))
+            self.logger.debug(u"actionControlSprinkler: \"%s\" On", dev.name)
             indigo.device.turnOn(int(dev.pluginProps["baseDevice"]))
         elif action.sprinklerAction == indigo.kSprinklerAction.AllZonesOff:
-            self.logger.debug(u"actionControlSprinkler: \"{}\" AllZonesOff".format(dev.name))
+            self.logger.debug(u"actionControlSprinkler: \"%s\" AllZonesOff", dev.name)
             indigo.device.turnOff(int(dev.pluginProps["baseDevice"]))
         
 
@@ -339,136 +2217,79 @@ class Plugin(indigo.PluginBase):
     ########################################################################
     # This method is called to generate a list of plugin identifiers / names
     ########################################################################
+    @timedCallback
     def getPluginList(self, filter="", valuesDict=None, typeId="", targetId=0):
+        self.catalog.ensureLoaded()
+        return self.catalog.pluginList(self.pluginId)
 
-        retList = []
-        indigoInstallPath = indigo.server.getInstallFolderPath()
-        pluginFolders =['Plugins', 'Plugins (Disabled)']
-        for pluginFolder in pluginFolders:
-            tempList = []
-            pluginsList = os.listdir(indigoInstallPath + '/' + pluginFolder)
-            for plugin in pluginsList:
-                # Check for Indigo Plugins and exclude 'system' plugins
-                if (plugin.lower().endswith('.indigoplugin')) and (not plugin[0:1] == '.'):
-                    # retrieve plugin Info.plist file
-                    path = indigoInstallPath + "/" + pluginFolder + "/" + plugin + "/Contents/Info.plist"
-                    try:
-                        pl = plistlib.readPlist(path)
-                    except:
-                        self.logger.warning(u"getPluginList: Unable to parse plist, skipping: %s" % (path))
-                    else:
-#                        self.logger.debug(u"getPluginList: reading plist: %s" % (path))
-                        bundleId = pl["CFBundleIdentifier"]
-                        if self.pluginId != bundleId:
-                            # Don't include self (i.e. this plugin) in the plugin list
-                            displayName = pl["CFBundleDisplayName"]
-                            # if disabled plugins folder, append 'Disabled' to name
-                            if pluginFolder == 'Plugins (Disabled)':
-                                displayName += ' [Disabled]'
-                            tempList.append((bundleId, displayName))
-            tempList.sort(key=lambda tup: tup[1])
-            retList = retList + tempList
-
-        return retList
-
+    @timedCallback
     def getDevices(self, filter="", valuesDict=None, typeId="", targetId=0):
 
-        retList = []
-
         deviceClass = valuesDict.get("deviceClass", "plugin")
         if deviceClass != "plugin":
-            for dev in indigo.devices.iter(deviceClass):
-                retList.append((dev.id, dev.name))
+            return list(self.deviceIndex.deviceList(("class", deviceClass)))
         else:
-            devicePlugin = valuesDict.get("devicePlugin", None)
-            for dev in indigo.devices.iter():
-                if dev.protocol == indigo.kProtocol.Plugin and dev.pluginId == devicePlugin:
-                    for pluginId, pluginDict in dev.globalProps.iteritems():
-                        pass
-                    retList.append((dev.id, dev.name))
-
-        retList.sort(key=lambda tup: tup[1])
-        return retList
+            return list(self.deviceIndex.deviceList(("plugin", valuesDict.get("devicePlugin", None))))
 
+    @timedCallback
     def getStateList(self, filter="", valuesDict=None, typeId="", targetId=0):
 
-        retList = []
         baseDeviceId = valuesDict.get("baseDevice", None)
-
         if not baseDeviceId:
-            return retList
-        
+            return []
+
         try:
-            baseDevice = indigo.devices[int(baseDeviceId)]
+            return list(self.deviceIndex.stateList(int(baseDeviceId)))
         except:
-            return retList
-        
-        for stateKey, stateValue in baseDevice.states.items():
-            retList.append((stateKey, stateKey))
-        retList.sort(key=lambda tup: tup[1])
-
-        return retList
+            return []
 
+    @timedCallback
     def getActionList(self, filter="", valuesDict=None, typeId="", targetId=0):
-
-        retList = ["use Standard Indigo Commands"]
-        indigoInstallPath = indigo.server.getInstallFolderPath()
-        pluginsList = os.listdir(indigoInstallPath + '/Plugins')
-        for plugin in pluginsList:
-            if (plugin.lower().endswith('.indigoplugin')) and (not plugin[0:1] == '.'):
-                path = indigoInstallPath + "/Plugins/" + plugin + "/Contents/Info.plist"
-                try:
-                    pl = plistlib.readPlist(path)
-                except:
-                    self.logger.warning(u"getActionList: Unable to parse plist, skipping: %s" % (path))
-                else:
-                    bundleId = pl["CFBundleIdentifier"]
-                    if bundleId == valuesDict.get("devicePlugin", None):
-                        self.logger.debug("getActionList, checking  bundleId = %s" % (bundleId))
-                        tree = ET.parse(indigoInstallPath + "/Plugins/" + plugin + "/Contents/Server Plugin/Actions.xml")
-                        actions = tree.getroot()
-                        for action in actions:
-                            if action.tag == "Action":
-                                self.logger.debug("getActionList, Action attribs = %s" % (action.attrib))
-                                name = action.find('Name')
-                                callBack = action.find('CallbackMethod')
-                                if name != None and callBack != None:
-                                    self.logger.debug("getActionList, Action id = %s, name = '%s', callBackMethod = %s" % (action.attrib["id"], name.text, callBack.text))
-                                    retList.append((action.attrib["id"], name.text))
-
+        self.catalog.ensureLoaded()
+        retList = ["use Standard Indigo Commands"] + self.catalog.actionList(valuesDict.get("devicePlugin", None))
         retList.sort(key=lambda tup: tup[1])
         return retList
 
+    @timedCallback
     def getActionFieldList(self, filter="", valuesDict=None, typeId="", targetId=0):
+        self.catalog.ensureLoaded()
+        retList = [(fieldId, fieldId) for fieldId in self.catalog.actionFieldList(valuesDict.get("devicePlugin", None), valuesDict.get("masqAction", None))]
+        retList.sort(key=lambda tup: tup[1])
+        return retList
 
+
+    ########################################
+    # Aggregate source list
+    ########################################
+
+    @timedCallback
+    def getAggregateSourceList(self, filter="", valuesDict=None, typeId="", targetId=0):
         retList = []
-        indigoInstallPath = indigo.server.getInstallFolderPath()
-        pluginsList = os.listdir(indigoInstallPath + '/Plugins')
-        for plugin in pluginsList:
-            if (plugin.lower().endswith('.indigoplugin')) and (not plugin[0:1] == '.'):
-                path = indigoInstallPath + "/Plugins/" + plugin + "/Contents/Info.plist"
-                try:
-                    pl = plistlib.readPlist(path)
-                except:
-                    self.logger.warning(u"getActionFieldList: Unable to parse plist, skipping: %s" % (path))
-                else:
-                    bundleId = pl["CFBundleIdentifier"]
-                    if bundleId == valuesDict.get("devicePlugin", None):
-                        tree = ET.parse(indigoInstallPath + "/Plugins/" + plugin + "/Contents/Server Plugin/Actions.xml")
-                        actions = tree.getroot()
-                        if actions:
-                            for action in actions:
-                                if action.tag == "Action" and action.attrib["id"] == valuesDict.get("masqAction", None):
-                                    configUI = action.find('ConfigUI')
-                                    for field in configUI:
-                                        self.logger.debug("ConfigUI List: child tag = %s, attrib = %s" % (field.tag, field.attrib))
-
-                                        if not bool(field.attrib.get("hidden", None)):
-                                            retList.append((field.attrib["id"], field.attrib["id"]))
-                        
-        retList.sort(key=lambda tup: tup[1])
+        for baseDeviceId, stateKey in parseSources(valuesDict.get("aggregateSources", u"")):
+            try:
+                name = indigo.devices[baseDeviceId].name
+            except KeyError:
+                name = u"missing device %d" % baseDeviceId
+            retList.append((u"%d:%s" % (baseDeviceId, stateKey), u"%s: %s" % (name, stateKey)))
         return retList
 
+    def addAggregateSource(self, valuesDict, typeId, devId):
+        sources = parseSources(valuesDict.get("aggregateSources", u""))
+        try:
+            source = (int(valuesDict.get("baseDevice", 0)), valuesDict.get("masqState", u""))
+        except ValueError:
+            return valuesDict
+        if source[0] and source[1] and source not in sources:
+            sources.append(source)
+            valuesDict["aggregateSources"] = formatSources(sources)
+        return valuesDict
+
+    def removeAggregateSources(self, valuesDict, typeId, devId):
+        selected = set(valuesDict.get("sourceList", []))
+        sources = [source for source in parseSources(valuesDict.get("aggregateSources", u"")) if u"%d:%s" % source not in selected]
+        valuesDict["aggregateSources"] = formatSources(sources)
+        return valuesDict
+
 
     # doesn't do anything, just needed to force other menus to dynamically refresh
 
@@ -476,15 +2297,24 @@ class Plugin(indigo.PluginBase):
         return valuesDict
 
 
+    @timedCallback
     def getDeviceConfigUiValues(self, pluginProps, typeId, devId):
-        self.logger.debug("getDeviceConfigUiValues, typeID = " + typeId)
+        self.logger.debug(u"getDeviceConfigUiValues, typeID = %s", typeId)
         valuesDict = indigo.Dict(pluginProps)
         errorsDict = indigo.Dict()
         return (valuesDict, errorsDict)
 
+    @timedCallback
     def validateDeviceConfigUi(self, valuesDict, typeId, devId):
-        self.logger.debug(u"validateDeviceConfigUi, typeID = " + typeId)
+        self.logger.debug(u"validateDeviceConfigUi, typeID = %s", typeId)
         errorsDict = indigo.Dict()
+        try:
+            compilePlan(typeId, valuesDict)
+            staleTimeout(valuesDict)
+        except PropError as err:
+            errorsDict[err.key] = unicode(err)
+        except KeyError:
+            pass
         if len(errorsDict) > 0:
             return (False, valuesDict, errorsDict)
         return (True, valuesDict)
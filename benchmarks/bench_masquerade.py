@@ -0,0 +1,252 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+## Offline benchmark for the Masquerade plugin.
+##
+## Loads plugin.py against the stub indigo module in this folder, creates base devices
+## and masquerades of every type in Devices.xml, then replays a storm of base device
+## changes through deviceUpdated and reports throughput, per-event latency and the
+## number of server calls per event.
+##
+## Run with the same Python as Indigo 7 (2.7):
+##      python2.7 benchmarks/bench_masquerade.py --bases 200 --masq-per-type 60 --events 20000
+
+import argparse
+import imp
+import json
+import os
+import random
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+kBenchDir = os.path.dirname(os.path.abspath(__file__))
+kPluginDir = os.path.join(kBenchDir, os.pardir, "Masquerade.indigoPlugin", "Contents", "Server Plugin")
+kPluginId = "com.flyingdiver.indigoplugin.masquerade"
+kBasePluginId = "com.example.indigoplugin.basedevices"
+
+sys.dont_write_bytecode = True     # don't leave .pyc files in the plugin bundle
+sys.path.insert(0, kBenchDir)
+import indigo
+
+import __builtin__
+__builtin__.indigo = indigo     # IndigoServer makes indigo a builtin for plugin code
+
+
+def loadPlugin(prefs=None):
+    if kPluginDir not in sys.path:
+        sys.path.insert(0, kPluginDir)
+    module = imp.load_source("plugin", os.path.join(kPluginDir, "plugin.py"))
+    pluginPrefs = indigo.Dict(prefs or {"logLevel": "20"})
+    return module.Plugin(kPluginId, "Masquerade", "bench", pluginPrefs), module
+
+
+def readDeviceTypes():
+    # {device type id: [masqSensorSubtype options]} from Devices.xml
+    deviceTypes = {}
+    for device in ET.parse(os.path.join(kPluginDir, "Devices.xml")).getroot().findall("Device"):
+        subtypes = [option.attrib["value"] for option in device.findall("ConfigUI/Field[@id='masqSensorSubtype']/List/Option")]
+        deviceTypes[device.attrib["id"]] = subtypes or [None]
+    return deviceTypes
+
+
+################################################################################
+#
+#   Scenario
+#
+################################################################################
+
+def baseStates(rng):
+    return {
+        "value":            round(rng.uniform(10.0, 30.0), 2),
+        "mode":             rng.choice(["on", "off"]),
+        "level":            rng.randint(0, 255),
+        "brightnessLevel":  rng.randint(0, 100),
+        "onOffState":       rng.choice([True, False]),
+    }
+
+
+def masqProps(module, deviceType, subtype, baseDevices, options):
+    baseDevice = baseDevices[0]
+    props = {"baseDevice": str(baseDevice.id), "deviceClass": "plugin", "devicePlugin": kBasePluginId,
+             "devVersCount": module.kCurDevVersCount}
+    if subtype is not None:
+        props["masqSensorSubtype"] = subtype
+
+    if deviceType == "masqSensor":
+        props.update(masqState="mode", matchString="on", reverse=False)
+    elif deviceType == "masqValueSensor":
+        props.update(masqState="value", deadbandAbs=str(options.deadband), minInterval="0")
+    elif deviceType == "masqDimmer":
+        props.update(masqState="level", lowLimitState="0", highLimitState="255", reverseState=False,
+                     masqAction="setLevel", masqValueField="level", lowLimitAction="0", highLimitAction="255",
+                     reverseAction=False, masqValueFormat="Decimal")
+    elif deviceType == "masqSpeedControl":
+        props.update(scaleFactor="25")
+    elif deviceType == "masqSprinkler":
+        pass
+    elif deviceType == "masqAggregate":
+        function = module.kAggregateFunctions[baseDevice.id % len(module.kAggregateFunctions)]
+        stateKey = "value" if function in module.kNumericAggregates else "onOffState"
+        props.update(aggregateFunction=function, matchString="",
+                     aggregateSources=module.formatSources([(device.id, stateKey) for device in baseDevices]))
+    else:
+        return None
+    return props
+
+
+def buildScenario(module, options, rng):
+    indigo.reset()
+    bases = []
+    for i in range(options.bases):
+        bases.append(indigo.devices.create(indigo.Device(None, u"Base %04d" % i, baseStates(rng), pluginId=kBasePluginId)))
+    unrelated = []
+    for i in range(options.unrelated):
+        unrelated.append(indigo.devices.create(indigo.Device(None, u"Other %04d" % i, baseStates(rng), protocol=indigo.kProtocol.ZWave)))
+
+    masquerades = []
+    for deviceType, subtypes in sorted(readDeviceTypes().iteritems()):
+        for i in range(options.masqPerType):
+            subtype = subtypes[i % len(subtypes)]
+            sourceDevices = [bases[(i + n) % len(bases)] for n in range(options.aggregateSources)]
+            props = masqProps(module, deviceType, subtype, sourceDevices, options)
+            if props is None:
+                continue
+            masquerades.append(indigo.devices.create(indigo.Device(None, u"%s %04d" % (deviceType, i), {}, props, deviceType, kPluginId)))
+
+    indigo.devices.notifications.clear()
+    return bases, unrelated, masquerades
+
+
+def nextStates(device, rng):
+    # one plausible change to a base device
+    key = rng.choice(["value", "value", "value", "mode", "level", "brightnessLevel", "onOffState"])
+    if key == "value":
+        return [{'key': key, 'value': round(device.states[key] + rng.gauss(0.0, 0.5), 2)}]
+    elif key == "mode":
+        return [{'key': key, 'value': "on" if rng.random() < 0.5 else "off"}]
+    elif key == "onOffState":
+        return [{'key': key, 'value': not device.states[key]}]
+    elif key == "level":
+        return [{'key': key, 'value': rng.randint(0, 255)}]
+    return [{'key': key, 'value': rng.randint(0, 100)}]
+
+
+################################################################################
+#
+#   Measurement
+#
+################################################################################
+
+def percentile(sortedValues, fraction):
+    if not sortedValues:
+        return 0.0
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * fraction))]
+
+
+def startDevices(plugin, masquerades):
+    # deviceStartComm for every masquerade, then the reconciliation pass the timer would run
+    indigo.server.calls.clear()
+    startTime = time.time()
+    for masquerade in masquerades:
+        plugin.deviceStartComm(indigo.devices[masquerade.id])
+    plugin.reconcileDevices()
+    indigo.devices.deliver(plugin)
+    return time.time() - startTime, dict((name, count) for name, count in indigo.server.calls.iteritems() if name != "log")
+
+
+def runBenchmark(options):
+    rng = random.Random(options.seed)
+    plugin, module = loadPlugin()
+    bases, unrelated, masquerades = buildScenario(module, options, rng)
+    plugin.startup()
+    startupTime, startupCalls = startDevices(plugin, masquerades)
+
+    indigo.server.calls.clear()
+    latencies = []
+    echoes = 0
+    stormStart = time.time()
+    for i in range(options.events):
+        if unrelated and rng.random() < options.unrelatedRatio:
+            device = rng.choice(unrelated)
+        else:
+            device = rng.choice(bases)
+        indigo.devices.changeStates(device.id, nextStates(device, rng))
+        notification = indigo.devices.notifications.popleft()
+
+        eventStart = time.time()
+        plugin.deviceUpdated(*notification[1:])
+        latencies.append(time.time() - eventStart)
+
+        echoes += indigo.devices.deliver(plugin)
+    stormTime = time.time() - stormStart
+    serverCalls = dict((name, count) for name, count in indigo.server.calls.iteritems() if name != "log")
+
+    for masquerade in masquerades:
+        plugin.deviceStopComm(indigo.devices[masquerade.id])
+    plugin.shutdown()
+
+    # restart, nothing changed while the plugin was down
+    plugin, module = loadPlugin(plugin.pluginPrefs)
+    plugin.startup()
+    restartTime, restartCalls = startDevices(plugin, masquerades)
+    plugin.shutdown()
+
+    latencies.sort()
+    return {
+        "bases":            len(bases),
+        "unrelated":        len(unrelated),
+        "masquerades":      len(masquerades),
+        "events":           options.events,
+        "startupSeconds":   startupTime,
+        "startupCalls":     startupCalls,
+        "restartSeconds":   restartTime,
+        "restartCalls":     restartCalls,
+        "stormSeconds":     stormTime,
+        "eventsPerSecond":  options.events / stormTime if stormTime else 0.0,
+        "latencyMicros":    dict((name, percentile(latencies, fraction) * 1e6) for name, fraction in
+                                 (("p50", 0.50), ("p90", 0.90), ("p99", 0.99), ("max", 1.0))),
+        "echoCallbacks":    echoes,
+        "serverCalls":      serverCalls,
+        "serverCallsPerEvent": float(sum(serverCalls.itervalues())) / options.events if options.events else 0.0,
+    }
+
+
+def printReport(result):
+    print(u"Masquerade benchmark: %d base devices, %d unrelated devices, %d masquerades" %
+          (result["bases"], result["unrelated"], result["masquerades"]))
+    print(u"  startup:      %.1f ms, server calls %s" % (result["startupSeconds"] * 1000.0, result["startupCalls"]))
+    print(u"  restart:      %.1f ms, server calls %s" % (result["restartSeconds"] * 1000.0, result["restartCalls"]))
+    print(u"  events:       %d in %.3f s, %.0f events/s" % (result["events"], result["stormSeconds"], result["eventsPerSecond"]))
+    latency = result["latencyMicros"]
+    print(u"  deviceUpdated latency (us): p50 %.1f  p90 %.1f  p99 %.1f  max %.1f" %
+          (latency["p50"], latency["p90"], latency["p99"], latency["max"]))
+    print(u"  server calls per event: %.3f" % result["serverCallsPerEvent"])
+    for name, count in sorted(result["serverCalls"].iteritems()):
+        print(u"      %-28s %8d  (%.3f per event)" % (name, count, float(count) / result["events"]))
+    print(u"  own-device echo callbacks: %d" % result["echoCallbacks"])
+
+
+def parseOptions(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for the Masquerade plugin")
+    parser.add_argument("--bases", type=int, default=100, help="number of masqueraded base devices")
+    parser.add_argument("--masq-per-type", dest="masqPerType", type=int, default=60, help="masquerades of each device type")
+    parser.add_argument("--unrelated", type=int, default=1000, help="devices in the install that nothing masquerades")
+    parser.add_argument("--unrelated-ratio", dest="unrelatedRatio", type=float, default=0.5,
+                        help="fraction of events that come from unrelated devices")
+    parser.add_argument("--events", type=int, default=20000, help="base device changes in the storm")
+    parser.add_argument("--aggregate-sources", dest="aggregateSources", type=int, default=8,
+                        help="sources feeding each aggregate masquerade")
+    parser.add_argument("--deadband", type=float, default=0.0, help="deadbandAbs for the value sensors")
+    parser.add_argument("--seed", type=int, default=1, help="random seed, the same seed replays the same storm")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    options = parseOptions()
+    result = runBenchmark(options)
+    if options.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        printReport(result)
@@ -0,0 +1,307 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+## Stand-in for the indigo module that IndigoServer injects into plugins.
+##
+## Only the parts of the API that Masquerade uses are here.  Server calls don't do
+## any IPC, they are counted in server.calls (and optionally kept in server.callLog).
+## Device changes made through the API are queued in devices.notifications, the
+## harness delivers them to the plugin like IndigoServer would.
+
+import copy
+import logging
+import os
+import time
+from collections import deque, Counter
+
+
+class Dict(dict):
+    pass
+
+
+class List(list):
+    pass
+
+
+class _Constants(object):
+
+    def __init__(self, *names):
+        for name in names:
+            setattr(self, name, name)
+
+
+kStateImageSel = _Constants("None", "Auto", "Error", "PowerOff", "PowerOn", "MotionSensor", "MotionSensorTripped",
+                            "TemperatureSensor", "TemperatureSensorOn", "HumiditySensor", "HumiditySensorOn",
+                            "LightSensor", "LightSensorOn", "EnergyMeterOff", "EnergyMeterOn",
+                            "SensorOff", "SensorOn", "SensorTripped", "TimerOff", "TimerOn")
+kDeviceAction = _Constants("TurnOn", "TurnOff", "Toggle", "SetBrightness", "BrightenBy", "DimBy", "RequestStatus", "Lock", "Unlock")
+kSpeedControlAction = _Constants("SetSpeedIndex", "SetSpeedLevel", "IncreaseSpeedIndex", "DecreaseSpeedIndex")
+kSprinklerAction = _Constants("ZoneOn", "AllZonesOff", "RunNewSchedule", "RunPreviousSchedule", "PauseSchedule",
+                              "ResumeSchedule", "StopSchedule", "PreviousZone", "NextZone")
+kProtocol = _Constants("Insteon", "X10", "ZWave", "Plugin")
+
+
+################################################################################
+
+class Server(object):
+
+    def __init__(self):
+        self.calls = Counter()          # API name -> number of calls
+        self.callLog = None             # set to a list to keep (name, args) of every call
+        self.installFolderPath = "/Library/Application Support/Perceptive Automation/Indigo 7"
+        self.plugins = {}               # bundle id -> object with isEnabled() / executeAction()
+
+    def record(self, name, *args):
+        self.calls[name] += 1
+        if self.callLog is not None:
+            self.callLog.append((name,) + args)
+
+    def log(self, message, type=None, isError=False):
+        self.record("log", message)
+
+    def getInstallFolderPath(self):
+        return self.installFolderPath
+
+    def getPlugin(self, bundleId):
+        self.record("getPlugin", bundleId)
+        plugin = self.plugins.get(bundleId)
+        if plugin is None:
+            plugin = self.plugins[bundleId] = RecordingPlugin(bundleId)
+        return plugin
+
+
+class RecordingPlugin(object):
+    # a target plugin that records the actions it is asked to run
+
+    def __init__(self, bundleId, delay=0.0):
+        self.pluginId = bundleId
+        self.delay = delay
+
+    def isEnabled(self):
+        server.record("isEnabled", self.pluginId)
+        return True
+
+    def executeAction(self, actionId, deviceId=0, props=None):
+        server.record("executeAction", self.pluginId, actionId, deviceId, props)
+        if self.delay:
+            time.sleep(self.delay)
+
+
+server = Server()
+
+
+################################################################################
+
+class Device(object):
+
+    def __init__(self, id, name, states=None, pluginProps=None, deviceTypeId="", pluginId="", protocol=kProtocol.Plugin):
+        self.id = id
+        self.name = name
+        self.states = Dict(states or {})
+        self.pluginProps = Dict(pluginProps or {})
+        self.globalProps = Dict()
+        self.deviceTypeId = deviceTypeId
+        self.pluginId = pluginId
+        self.protocol = protocol
+        self.enabled = True
+        self.displayStateImageSel = kStateImageSel.Auto
+        self.errorState = u""
+
+    def __copy__(self):
+        other = Device.__new__(Device)
+        other.__dict__.update(self.__dict__)
+        other.states = Dict(self.states)
+        other.pluginProps = Dict(self.pluginProps)
+        return other
+
+    @property
+    def onState(self):
+        return self.states.get("onOffState", False)
+
+    @property
+    def brightness(self):
+        return self.states.get("brightnessLevel", 0)
+
+    @property
+    def ownerProps(self):
+        return self.pluginProps
+
+    def refreshFromServer(self):
+        self.__dict__.update(copy.copy(devices.stored(self.id)).__dict__)
+
+    def updateStateOnServer(self, key, value, uiValue=None, decimalPlaces=None):
+        server.record("updateStateOnServer", self.id, key)
+        devices.changeStates(self.id, [{'key': key, 'value': value, 'uiValue': uiValue}])
+
+    def updateStatesOnServer(self, stateList):
+        server.record("updateStatesOnServer", self.id, [state['key'] for state in stateList])
+        devices.changeStates(self.id, stateList)
+
+    def updateStateImageOnServer(self, image):
+        server.record("updateStateImageOnServer", self.id, image)
+        devices.stored(self.id).displayStateImageSel = image
+
+    def setErrorStateOnServer(self, message):
+        server.record("setErrorStateOnServer", self.id, message)
+        devices.changeAttributes(self.id, errorState=message or u"")
+
+    def replacePluginPropsOnServer(self, props):
+        server.record("replacePluginPropsOnServer", self.id)
+        devices.changeAttributes(self.id, pluginProps=Dict(props))
+
+    def stateListOrDisplayStateIdChanged(self):
+        server.record("stateListOrDisplayStateIdChanged", self.id)
+
+
+class DeviceList(object):
+
+    def __init__(self):
+        self.devices = {}
+        self.notifications = deque()    # ("deviceUpdated", old, new) etc. waiting for deliver()
+        self.nextId = 1000000
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __contains__(self, key):
+        return key in self.devices
+
+    def __getitem__(self, key):
+        return copy.copy(self.stored(key))
+
+    def stored(self, key):
+        if isinstance(key, basestring):
+            for device in self.devices.itervalues():
+                if device.name == key:
+                    return device
+        return self.devices[key]
+
+    def iter(self, filter=""):
+        for device in self.devices.values():
+            if filter in ("", "self") or filter == "indigo." + device.protocol.lower():
+                yield copy.copy(device)
+
+    def iteritems(self):
+        for deviceId in self.devices.keys():
+            yield deviceId, copy.copy(self.devices[deviceId])
+
+    def subscribeToChanges(self):
+        server.record("subscribeToChanges")
+
+    def create(self, device):
+        if device.id is None:
+            device.id = self.nextId
+            self.nextId += 1
+        self.devices[device.id] = device
+        self.notifications.append(("deviceCreated", copy.copy(device)))
+        return device
+
+    def delete(self, deviceId):
+        device = self.devices.pop(deviceId)
+        self.notifications.append(("deviceDeleted", device))
+
+    def changeStates(self, deviceId, stateList):
+        device = self.devices[deviceId]
+        old = copy.copy(device)
+        for state in stateList:
+            device.states[state['key']] = state['value']
+            if state.get('uiValue') is not None:
+                device.states[state['key'] + u".ui"] = state['uiValue']
+        self.notifications.append(("deviceUpdated", old, copy.copy(device)))
+        return old
+
+    def changeAttributes(self, deviceId, **attributes):
+        device = self.devices[deviceId]
+        old = copy.copy(device)
+        device.__dict__.update(attributes)
+        self.notifications.append(("deviceUpdated", old, copy.copy(device)))
+
+    def deliver(self, plugin):
+        # hand queued change notifications to the plugin, including any its callbacks cause
+        delivered = 0
+        while self.notifications:
+            notification = self.notifications.popleft()
+            getattr(plugin, notification[0])(*notification[1:])
+            delivered += 1
+        return delivered
+
+
+devices = DeviceList()
+
+
+class _DeviceCommands(object):
+
+    def turnOn(self, device, **kwargs):
+        server.record("device.turnOn", device)
+
+    def turnOff(self, device, **kwargs):
+        server.record("device.turnOff", device)
+
+    def toggle(self, device, **kwargs):
+        server.record("device.toggle", device)
+
+    def enable(self, device, value=True):
+        server.record("device.enable", getattr(device, "id", device), value)
+
+
+class _DimmerCommands(object):
+
+    def setBrightness(self, device, value=0, **kwargs):
+        server.record("dimmer.setBrightness", device, value)
+
+
+device = _DeviceCommands()
+dimmer = _DimmerCommands()
+
+
+################################################################################
+
+class PluginBase(object):
+
+    class StopThread(Exception):
+        pass
+
+    def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+        self.pluginId = pluginId
+        self.pluginDisplayName = pluginDisplayName
+        self.pluginVersion = pluginVersion
+        self.pluginPrefs = pluginPrefs
+        self.stopThread = False
+
+        # IndigoServer sends everything to the plugin log file at DEBUG, and INFO and up to the event log
+        self.logger = logging.getLogger("Plugin")
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+        self.plugin_file_handler = logging.FileHandler(os.devnull)
+        self.plugin_file_handler.setLevel(logging.DEBUG)
+        self.indigo_log_handler = logging.StreamHandler(open(os.devnull, "w"))
+        self.indigo_log_handler.setLevel(logging.INFO)
+        self.logger.addHandler(self.plugin_file_handler)
+        self.logger.addHandler(self.indigo_log_handler)
+
+    def sleep(self, seconds):
+        if self.stopThread:
+            raise self.StopThread()
+        time.sleep(seconds)
+        if self.stopThread:
+            raise self.StopThread()
+
+    def stopConcurrentThread(self):
+        self.stopThread = True
+
+    def deviceCreated(self, dev):
+        pass
+
+    def deviceUpdated(self, origDev, newDev):
+        pass
+
+    def deviceDeleted(self, dev):
+        pass
+
+
+def reset():
+    # fresh server and device list, for running several scenarios in one process
+    server.__init__()
+    devices.__init__()
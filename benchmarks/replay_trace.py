@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+## Replays an event trace recorded with Plugins > Masquerade > Start Event Trace.
+##
+## The "base" and "masq" records in the trace become devices in the stub indigo
+## module, then the "update" records are fed through deviceUpdated and the "action"
+## records through the action callbacks, in order.  --speed max replays as fast as
+## possible for profiling and before/after comparisons, --speed original keeps the
+## recorded spacing (divided by --rate).  Timers are run between events on the
+## replay clock.
+##
+##      python2.7 benchmarks/replay_trace.py "Masquerade Trace.jsonl" --speed max
+
+import argparse
+import json
+import time
+
+from bench_masquerade import indigo, kPluginId, loadPlugin, percentile
+
+kActionAttributes = {   # action record kind: (callback, attribute holding the command, command constants)
+    "device":       ("actionControlDevice", "deviceAction", indigo.kDeviceAction),
+    "speed":        ("actionControlSpeedControl", "speedControlAction", indigo.kSpeedControlAction),
+    "sprinkler":    ("actionControlSprinkler", "sprinklerAction", indigo.kSprinklerAction),
+}
+
+
+class Action(object):
+    # stands in for the action object IndigoServer passes to the action callbacks
+
+    def __init__(self, attribute, command, actionValue):
+        setattr(self, attribute, command)
+        self.actionValue = actionValue
+
+
+def readTrace(path):
+    with open(path) as traceFile:
+        return [json.loads(line) for line in traceFile if line.strip()]
+
+
+def buildDevices(records):
+    # the first record for each device creates it, later "masq" records are props edits made during the trace
+    indigo.reset()
+    masqIds = []
+    for record in records:
+        if record["id"] in indigo.devices:
+            continue
+        if record["type"] == "base":
+            indigo.devices.create(indigo.Device(record["id"], record["name"], record["states"],
+                                                pluginId=record["pluginId"] or "", protocol=record["protocol"]))
+        elif record["type"] == "masq":
+            indigo.devices.create(indigo.Device(record["id"], record["name"], record["states"], record["props"],
+                                                record["deviceTypeId"], kPluginId))
+            masqIds.append(record["id"])
+    indigo.devices.notifications.clear()
+    return masqIds
+
+
+def replayRecord(plugin, record):
+    if record["type"] == "update":
+        indigo.devices.changeStates(record["id"], [{'key': key, 'value': value} for key, value in sorted(record["states"].iteritems())])
+        plugin.deviceUpdated(*indigo.devices.notifications.popleft()[1:])
+    elif record["type"] == "masq":
+        indigo.devices.changeAttributes(record["id"], pluginProps=indigo.Dict(record["props"]))
+        plugin.deviceUpdated(*indigo.devices.notifications.popleft()[1:])
+    elif record["type"] == "action":
+        callback, attribute, constants = kActionAttributes[record["kind"]]
+        action = Action(attribute, getattr(constants, record["action"], record["action"]), record["value"])
+        getattr(plugin, callback)(action, indigo.devices[record["id"]])
+
+
+def runReplay(options):
+    records = readTrace(options.trace)
+    plugin, module = loadPlugin()
+    masqIds = buildDevices(records)
+    plugin.startup()
+    for masqDeviceId in masqIds:
+        plugin.deviceStartComm(indigo.devices[masqDeviceId])
+    plugin.reconcileDevices()
+    indigo.devices.deliver(plugin)
+
+    events = []
+    recorded = set()
+    for record in records:
+        if record["type"] == "masq" and record["id"] not in recorded:
+            recorded.add(record["id"])      # the device as it was when tracing started
+        elif record["type"] in ("update", "action", "masq") and record["id"] in indigo.devices:
+            events.append(record)
+    indigo.server.calls.clear()
+    latencies = []
+    echoes = 0
+    traceStart = events[0]["t"] if events else 0.0
+    replayStart = time.time()
+    for record in events:
+        if options.speed == "original":
+            delay = (record["t"] - traceStart) / options.rate - (time.time() - replayStart)
+            if delay > 0:
+                time.sleep(delay)
+
+        eventStart = time.time()
+        replayRecord(plugin, record)
+        latencies.append(time.time() - eventStart)
+
+        echoes += indigo.devices.deliver(plugin)
+        for key, callback in plugin.timers.popDue(time.time()):
+            callback()
+        echoes += indigo.devices.deliver(plugin)
+    replayTime = time.time() - replayStart
+
+    drainStart = time.time()
+    while plugin.dispatcher.stats()["queueDepth"] and time.time() - drainStart < 10.0:
+        time.sleep(0.01)
+    stats = plugin.perfSnapshot()
+    plugin.shutdown()
+
+    latencies.sort()
+    serverCalls = dict((name, count) for name, count in indigo.server.calls.iteritems() if name != "log")
+    return {
+        "trace":            options.trace,
+        "masquerades":      len(masqIds),
+        "events":           len(events),
+        "traceSeconds":     (events[-1]["t"] - traceStart) if events else 0.0,
+        "replaySeconds":    replayTime,
+        "eventsPerSecond":  len(events) / replayTime if replayTime else 0.0,
+        "latencyMicros":    dict((name, percentile(latencies, fraction) * 1e6) for name, fraction in
+                                 (("p50", 0.50), ("p90", 0.90), ("p99", 0.99), ("max", 1.0))),
+        "echoCallbacks":    echoes,
+        "serverCalls":      serverCalls,
+        "counters":         stats["counters"],
+        "dispatch":         stats["dispatch"],
+    }
+
+
+def printReport(result):
+    print(u"Replayed %s: %d events for %d masquerades" % (result["trace"], result["events"], result["masquerades"]))
+    print(u"  recorded over %.1f s, replayed in %.3f s, %.0f events/s" %
+          (result["traceSeconds"], result["replaySeconds"], result["eventsPerSecond"]))
+    latency = result["latencyMicros"]
+    print(u"  event latency (us): p50 %.1f  p90 %.1f  p99 %.1f  max %.1f" %
+          (latency["p50"], latency["p90"], latency["p99"], latency["max"]))
+    for name, count in sorted(result["serverCalls"].iteritems()):
+        print(u"      %-28s %8d" % (name, count))
+    print(u"  own-device echo callbacks: %d" % result["echoCallbacks"])
+    print(u"  actions dispatched: %(dispatched)d, coalesced: %(coalesced)d, failed: %(failed)d" % result["dispatch"])
+
+
+def parseOptions(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a Masquerade event trace against the stub indigo module")
+    parser.add_argument("trace", help="trace file saved by Start Event Trace")
+    parser.add_argument("--speed", choices=("max", "original"), default="max", help="replay as fast as possible or with the recorded timing")
+    parser.add_argument("--rate", type=float, default=1.0, help="with --speed original, replay this many times faster than recorded")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    options = parseOptions()
+    result = runReplay(options)
+    if options.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        printReport(result)